@@ -17,6 +17,7 @@
 
 import os
 import logging
+import shutil
 from urllib.parse import urljoin
 from io import BytesIO
 from collections import defaultdict
@@ -44,7 +45,7 @@
 from allura import model
 from allura.controllers import BaseController
 from allura.lib.decorators import require_post, memoize
-from allura.lib.utils import permanent_redirect, ConfigProxy
+from allura.lib.utils import permanent_redirect, ConfigProxy, chunked_find
 from allura import model as M
 from allura.tasks import index_tasks
 import six
@@ -236,6 +237,8 @@ class Application(ActivityObject):
     :cvar bool searchable: If True, show search box in the left menu of this
         Application. Default is True.
     :cvar bool exportable: Default is False, Application can't be exported to json.
+    :cvar bool incremental_export: Default is False.  If True, :meth:`bulk_export`
+        takes a ``since`` datetime and exports only what changed after it.
     :cvar list permissions: Named permissions used by instances of this
         Application. Default is [].
     :cvar dict permissions_desc: Descriptions of the named permissions.
@@ -292,6 +295,7 @@ class Application(ActivityObject):
     max_instances = float("inf")
     searchable = False
     exportable = False
+    incremental_export = False
     DiscussionClass = model.Discussion
     PostClass = model.Post
     AttachmentClass = model.DiscussionAttachment
@@ -765,10 +769,113 @@ def bulk_export(self, f, export_path='', with_attachments=False):
 
         :param f: File Object to write to
 
-        Set exportable to True for applications implementing this.
+        Set exportable to True for applications implementing this.  Set
+        incremental_export to True as well if it accepts a ``since`` datetime
+        to only export what changed after it (see :meth:`bulk_export_query`).
         """
         raise NotImplementedError('bulk_export')
 
+    def bulk_export_query(self, query, since=None):
+        """Narrow ``query`` for :meth:`bulk_export_chunks` to the artifacts
+        changed since the datetime ``since``: edited, or with new,
+        edited or deleted comments, or with new attachments.  Returns
+        ``query`` unchanged if ``since`` is None.
+        """
+        if since is None:
+            return query
+        app_config_id = self.config._id
+        changed_ids = set()
+        thread_ids = set()
+        for att in M.BaseAttachment.query.find({
+                'app_config_id': app_config_id,
+                '_id': {'$gt': ObjectId.from_datetime(since)}}):
+            if getattr(att, 'thread_id', None):
+                thread_ids.add(att.thread_id)
+            else:
+                changed_ids.add(att.artifact_id)
+        for post in self.PostClass.query.find({
+                'app_config_id': app_config_id,
+                'mod_date': {'$gte': since}}):
+            thread_ids.add(post.thread_id)
+        # deleting a comment updates its thread's stats, and so its mod_date
+        ref_ids = [thread.ref_id for thread in self.DiscussionClass.thread_class().query.find({
+            'app_config_id': app_config_id,
+            '$or': [{'mod_date': {'$gte': since}},
+                    {'_id': {'$in': list(thread_ids)}}]})]
+        for ref in M.ArtifactReference.query.find({'_id': {'$in': ref_ids}}):
+            changed_ids.add(ref.artifact_reference.artifact_id)
+        return dict(query, **{'$or': [{'mod_date': {'$gte': since}},
+                                      {'_id': {'$in': list(changed_ids)}}]})
+
+    def bulk_export_chunks(self, cls, query, pagesize=100):
+        """Yield the artifacts of ``cls`` matching ``query`` for
+        :meth:`bulk_export`, a batch at a time in ``_id`` order.
+
+        Each batch's discussion threads, comments and attachment metadata are
+        loaded with a few queries up front rather than by each artifact's
+        ``__json__``, and the batch is flushed and dropped from the session
+        once the caller moves on, so exporting a large tool uses constant memory.
+        """
+        for artifacts in chunked_find(cls, query, pagesize):
+            attachments = self._prefill_for_export(artifacts)
+            yield artifacts
+            # flush whatever the caller changed (e.g. threads created for
+            # artifacts without one) before dropping the batch
+            M.artifact_orm_session.flush()
+            M.artifact_orm_session.clear()
+            for att in attachments:
+                session(att).expunge(att)
+
+    def _prefill_for_export(self, artifacts):
+        """Preload what ``__json__`` of ``artifacts`` needs, returning the
+        attachments loaded"""
+        loaded_attachments = []
+        by_index_id = {a.index_id(): a for a in artifacts}
+        threads_by_ref = defaultdict(list)
+        for thread in M.Thread.query.find(dict(ref_id={'$in': list(by_index_id)})):
+            threads_by_ref[thread.ref_id].append(thread)
+        # artifacts without a thread, or with duplicates to merge, are left for
+        # Artifact.discussion_thread to handle
+        threads = [ts[0] for ts in threads_by_ref.values() if len(ts) == 1]
+        for thread in threads:
+            by_index_id[thread.ref_id]._export_thread = thread
+        if threads:
+            posts_by_thread = defaultdict(list)
+            posts = threads[0].post_class().query.find(dict(
+                thread_id={'$in': [t._id for t in threads]},
+                status='ok',
+                deleted=False,
+            )).sort('timestamp').all()
+            for post in posts:
+                posts_by_thread[post.thread_id].append(post)
+            post_attachments = defaultdict(list)
+            for att in threads[0].attachment_class().query.find(dict(
+                    app_config_id=self.config._id,
+                    artifact_id={'$in': [p._id for p in posts]},
+                    type='attachment')):
+                post_attachments[att.post_id].append(att)
+                loaded_attachments.append(att)
+            for post in posts:
+                post._attachments = post_attachments[post._id]
+            for thread in threads:
+                thread._export_posts = posts_by_thread[thread._id]
+        try:
+            attachment_class = artifacts[0].attachment_class()
+        except NotImplementedError:
+            return loaded_attachments
+        attachments = defaultdict(list)
+        artifact_ids = [a._id for a in artifacts]
+        for att in attachment_class.query.find({
+                'app_config_id': self.config._id,
+                # some artifact_ids are ObjectIds and some are strings
+                'artifact_id': {'$in': artifact_ids + [str(_id) for _id in artifact_ids]},
+                'type': 'attachment'}):
+            attachments[str(att.artifact_id)].append(att)
+            loaded_attachments.append(att)
+        for artifact in artifacts:
+            artifact._attachments = attachments[str(artifact._id)]
+        return loaded_attachments
+
     def doap(self, parent):
         """App's representation for DOAP API.
 
@@ -810,7 +917,8 @@ def save_attachments(self, path, attachments):
                 os.path.basename(attachment.filename)
             )
             with open(attachment_path.encode('utf8', 'replace'), 'wb') as fl:
-                fl.write(attachment.rfile().read())
+                # copy in chunks rather than reading whole (possibly huge) files into memory
+                shutil.copyfileobj(attachment.rfile(), fl, 1024 * 1024)
 
     def default_redirect(self):
         """Redirect to url if first tool in a project. This method raises a
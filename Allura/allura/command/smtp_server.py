@@ -15,11 +15,12 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
-import smtpd
-import asyncore
+import asyncio
 
 import faulthandler
 import tg
+from aiosmtpd.smtp import SMTP
+from ming.odm import session
 from paste.script import command
 
 import allura.tasks
@@ -42,21 +43,122 @@ class SMTPServerCommand(base.Command):
     def command(self):
         faulthandler.enable()
         self.basic_setup()
-        MailServer((tg.config.get('forgemail.host', '0.0.0.0'),
-                    asint(tg.config.get('forgemail.port', 8825))),
-                   None)
-        asyncore.loop()
+        server = MailServer(
+            (tg.config.get('forgemail.host', '0.0.0.0'),
+             asint(tg.config.get('forgemail.port', 8825))),
+            max_connections=asint(tg.config.get('forgemail.max_connections', 100)),
+            max_message_size=asint(tg.config.get('forgemail.max_message_size', 33554432)),
+            batch_size=asint(tg.config.get('forgemail.task_batch_size', 50)),
+            batch_interval=float(tg.config.get('forgemail.task_batch_interval', 0.5)),
+        )
+        asyncio.run(server.serve_forever())
 
 
-class MailServer(smtpd.SMTPServer):
+class _SMTP(SMTP):
+    """SMTP protocol which keeps count of the active sessions"""
 
-    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+    def __init__(self, mail_server, **kw):
+        super().__init__(mail_server, **kw)
+        self.mail_server = mail_server
+
+    def connection_made(self, transport):
+        if self.transport is None:  # not again after STARTTLS
+            self.mail_server.active_connections += 1
+        super().connection_made(transport)
+
+    def connection_lost(self, error):
+        self.mail_server.active_connections -= 1
+        super().connection_lost(error)
+
+
+class _TooManyConnections(asyncio.Protocol):
+    """Refuses a session, used once ``max_connections`` are active"""
+
+    def connection_made(self, transport):
+        transport.write(b'421 Too many connections, try again later\r\n')
+        transport.close()
+
+
+class MailServer:
+    """Inbound SMTP listener which hands messages to taskd.
+
+    Accepted messages are queued in memory and posted as ``route_email`` tasks
+    in batches of up to ``batch_size``, or every ``batch_interval`` seconds,
+    whichever comes first.  A message is only answered with ``250 OK`` once its
+    task is saved, so the sender retries it if that fails or the server stops.
+    Tasks are posted from the event loop thread, since the ming sessions and tg
+    context are thread-local.
+    """
+
+    def __init__(self, listen_addr, max_connections=100, max_message_size=33554432,
+                 batch_size=50, batch_interval=0.5):
+        self.host, self.port = listen_addr
+        self.max_connections = max_connections
+        self.max_message_size = max_message_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.active_connections = 0
+        self.pending = []
+        self.waiting = []
+
+    def protocol_factory(self):
+        if self.active_connections >= self.max_connections:
+            return _TooManyConnections()
+        return _SMTP(self, data_size_limit=self.max_message_size, enable_SMTPUTF8=True)
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(self.protocol_factory, self.host, self.port)
+        base.log.info('Listening for mail on %s:%s', self.host, self.port)
+        async with server:
+            while True:
+                await asyncio.sleep(self.batch_interval)
+                self.flush()
+
+    async def handle_DATA(self, server, session, envelope):
+        posted = asyncio.get_running_loop().create_future()
+        self.process_message(session.peer, envelope.mail_from, envelope.rcpt_tos, envelope.original_content,
+                             posted=posted)
         try:
-            base.log.info('Msg Received from %s for %s', mailfrom, rcpttos)
-            base.log.info(' (%d bytes)', len(data))
-            task = allura.tasks.mail_tasks.route_email.post(
-                peer=peer, mailfrom=mailfrom, rcpttos=rcpttos,
-                data=h.really_unicode(data))
-            base.log.info(f'Msg passed along as task {task._id}')
+            await posted
         except Exception:
-            base.log.exception('Error handling msg')
+            return '451 Requested action aborted: error in processing'
+        return '250 OK'
+
+    def process_message(self, peer, mailfrom, rcpttos, data, posted=None, **kwargs):
+        """Queue a message.  ``posted`` is a future, resolved once its task is saved"""
+        base.log.info('Msg Received from %s for %s', mailfrom, rcpttos)
+        base.log.info(' (%d bytes)', len(data))
+        self.pending.append(dict(
+            peer=peer, mailfrom=mailfrom, rcpttos=rcpttos,
+            data=h.really_unicode(data)))
+        if posted is not None:
+            self.waiting.append(posted)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Post a ``route_email`` task for every queued message, with a single session flush"""
+        if not self.pending:
+            return []
+        batch, self.pending = self.pending, []
+        waiting, self.waiting = self.waiting, []
+        tasks = []
+        try:
+            for msg in batch:
+                tasks.append(allura.tasks.mail_tasks.route_email.post(flush_immediately=False, **msg))
+            session(tasks[0]).flush()
+        except Exception as e:
+            base.log.exception('Error handling msgs')
+            # the senders are told to retry, so don't save them with a later batch
+            for task in tasks:
+                session(task).expunge(task)
+            for posted in waiting:
+                if not posted.done():
+                    posted.set_exception(e)
+            return []
+        base.log.info('%d msgs passed along as tasks %s', len(tasks), [t._id for t in tasks])
+        for posted in waiting:
+            if not posted.done():
+                posted.set_result(None)
+        return tasks
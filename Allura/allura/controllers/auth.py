@@ -20,6 +20,7 @@
 from base64 import b32encode
 from datetime import datetime
 import re
+import time
 import warnings
 from urllib.parse import urlparse, urljoin
 
@@ -31,7 +32,7 @@
 from tg import tmpl_context as c, app_globals as g
 from tg import request, response
 from webob import exc as wexc
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 with warnings.catch_warnings():  # ignore py2 CryptographyDeprecationWarning
     warnings.filterwarnings('ignore')
     from cryptography.hazmat.primitives.twofactor import InvalidToken
@@ -56,7 +57,7 @@
     DisableAccountForm)
 from allura.lib.widgets import forms, form_fields as ffw
 from allura.lib import mail_util
-from allura.lib.multifactor import TotpService, RecoveryCodeService
+from allura.lib.multifactor import TotpService, RecoveryCodeService, check_rate_limit
 from allura.lib import utils
 from allura.controllers import BaseController
 from allura.tasks.mail_tasks import send_system_mail_to_user
@@ -484,7 +485,11 @@ def repo_permissions(self, repo_path=None, username=None, **kw):
             return dict(disallow, error='unknown user')
         if not repo_path:
             return dict(allow_write=self._auth_repos(user))
+        return self._repo_permissions(user, repo_path)
 
+    def _repo_permissions(self, user, repo_path):
+        disallow = dict(allow_read=False, allow_write=False,
+                        allow_create=False)
         parts = [p for p in repo_path.split(os.path.sep) if p]
         # strip the tool name
         parts = parts[1:]
@@ -512,6 +517,97 @@ def repo_permissions(self, repo_path=None, username=None, **kw):
                     allow_write=has_access(c.app, 'write')(user=user),
                     allow_create=has_access(c.app, 'create')(user=user))
 
+    @expose('json:')
+    @require_post()
+    def repo_access(self, **kw):
+        """Check a user's credentials and their permissions on a repo, in one request.
+
+        Used by SCM HTTP access handlers.  Expects a JSON body (so it isn't
+        subject to the CSRF form check) with ``repo_path`` (as in
+        :meth:`repo_permissions`), and optionally ``username`` and
+        ``password``.  Users with multifactor auth enabled append their
+        6-digit TOTP code to the password.
+
+        Returns JSON with ``authenticated`` and the ``allow_*`` permissions.
+        Anonymous requests get anonymous permissions.
+
+        Like a web login, an expired password or one found in a breach (see
+        ``auth.hibp_password_check``) isn't accepted.  After
+        ``auth.scm_access.rate_limit.num`` failed checks within
+        ``auth.scm_access.rate_limit.time`` seconds, the user's checks are
+        refused with a 429 until older failures leave that window.
+        """
+        if not kw and request.content_type == 'application/json':
+            kw = request.json_body
+        username = kw.get('username')
+        password = kw.get('password')
+        repo_path = kw.get('repo_path')
+        disallow = dict(authenticated=False, allow_read=False, allow_write=False,
+                        allow_create=False)
+        if not repo_path:
+            response.status = 400
+            return dict(disallow, error='missing repo_path')
+        if not username:
+            return dict(self._repo_permissions(M.User.anonymous(), repo_path), authenticated=False)
+
+        user = M.User.by_username(username)
+        if not user or user.disabled or user.pending or not password:
+            return disallow
+        if self._scm_access_locked_out(user):
+            h.auditlog_user('SCM access check - rate limit', user=user)
+            response.status = 429
+            return dict(disallow, error='rate limit exceeded')
+        auth_provider = plugin.AuthenticationProvider.get(request)
+        if user.get_pref('multifactor'):
+            password, code = password[:-6], password[-6:]
+            if not auth_provider.validate_password(user, password):
+                h.auditlog_user('Failed login via SCM access check', user=user)
+                self._record_scm_access_failure(user)
+                return disallow
+            try:
+                totp_service = TotpService.get()
+                totp_service.verify(totp_service.get_totp(user), code, user)
+            except InvalidToken:
+                h.auditlog_user('Multifactor login via SCM access check - invalid code', user=user)
+                self._record_scm_access_failure(user)
+                return disallow
+            except MultifactorRateLimitError:
+                h.auditlog_user('Multifactor login via SCM access check - rate limit', user=user)
+                response.status = 429
+                return dict(disallow, error='rate limit exceeded')
+        elif not auth_provider.validate_password(user, password):
+            h.auditlog_user('Failed login via SCM access check', user=user)
+            self._record_scm_access_failure(user)
+            return disallow
+
+        if auth_provider.is_password_expired(user):
+            h.auditlog_user('SCM access check; Password expired', user=user)
+            return dict(disallow, error='password expired')
+        try:
+            change_needed = auth_provider.login_check_password_change_needed(
+                user, password, auth_provider.get_login_detail(request, user))
+        except wexc.HTTPBadRequest:
+            change_needed = True
+        if change_needed:
+            return dict(disallow, error='password change needed')
+        return dict(self._repo_permissions(user, repo_path), authenticated=True)
+
+    def _scm_access_rate_limit(self):
+        return (asint(config.get('auth.scm_access.rate_limit.num', 5)),
+                asint(config.get('auth.scm_access.rate_limit.time', 300)))
+
+    def _scm_access_locked_out(self, user):
+        num_allowed, time_allowed = self._scm_access_rate_limit()
+        now = time.time()
+        failures = user.get_tool_data('allura', 'scm_access_failures') or []
+        return len([t for t in failures if now - t <= time_allowed]) >= num_allowed
+
+    def _record_scm_access_failure(self, user):
+        num_allowed, time_allowed = self._scm_access_rate_limit()
+        failures = user.get_tool_data('allura', 'scm_access_failures') or []
+        ok, failures = check_rate_limit(num_allowed, time_allowed, failures)
+        user.set_tool_data('allura', scm_access_failures=failures)
+
     @expose('jinja:allura:templates/pwd_expired.html')
     @without_trailing_slash
     def pwd_expired(self, **kw):
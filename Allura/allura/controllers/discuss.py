@@ -125,8 +125,8 @@ def get_feed(self, project, app, user):
         Overrides :meth:`allura.controllers.feed.FeedController.get_feed`.
 
         """
-        def query(since, until, page, limit, **kwargs):
-            if not since and not until and not page:
+        def query(since, until, page, limit, after=None, **kwargs):
+            if not since and not until and not page and not after:
                 # simplest default case, so make the threads list shorter by grabbing only needed ones
                 discussion_threads = self.discussion.thread_class().query.find(dict(
                     discussion_id=self.discussion._id,
@@ -38,8 +38,8 @@ def __init__(self, query, title, url, description=None):
         """
         :param query: mongo criteria to query the Feed collection.
                       Pagination & filter criteria will be added in automatically
-                      Can be a function to return criteria, which will be passed args (since, until, page, limit) for
-                        advanced optimization.
+                      Can be a function to return criteria, which will be passed args (since, until, page, limit)
+                        and the ``after`` page token as a keyword arg, for advanced optimization.
         :param title: feed title
         :param url: feed's own url
         :param description: feed description
@@ -85,20 +85,29 @@ def _get_feed_type(self, request):
         since=h.DateTimeConverter(if_empty=None, if_invalid=None),
         until=h.DateTimeConverter(if_empty=None, if_invalid=None),
         page=V.Int(if_empty=None, if_invalid=None),
-        limit=V.Int(if_empty=None, if_invalid=None)))
-    def feed(self, since=None, until=None, page=None, limit=None, **kw):
+        limit=V.Int(if_empty=None, if_invalid=None),
+        after=V.UnicodeString(if_empty=None)))
+    def feed(self, since=None, until=None, page=None, limit=None, after=None, **kw):
         """Return a utf8-encoded XML feed (RSS or Atom) to the browser.
+
+        A ``Link: rel="next"`` header points to the next page of the feed.
         """
         feed_def = self.get_feed(c.project, c.app, c.user)
         if not feed_def:
             raise exc.HTTPNotFound
-        feed = M.Feed.feed(
-            feed_def.query,
-            self._get_feed_type(request),
-            feed_def.title,
-            feed_def.url,
-            feed_def.description,
-            since, until, page, limit)
+        try:
+            feed = M.Feed.feed(
+                feed_def.query,
+                self._get_feed_type(request),
+                feed_def.title,
+                feed_def.url,
+                feed_def.description,
+                since, until, page, limit, after)
+        except ValueError as e:
+            raise exc.HTTPBadRequest(str(e))
+        if feed.next_after:
+            next_url = h.querystring(request, dict(page=None, after=feed.next_after))
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
         response.headers['Content-Type'] = ''
         response.content_type = 'application/xml'
         return feed.writeString('utf-8')
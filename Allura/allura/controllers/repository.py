@@ -765,7 +765,47 @@ def tarball_status(self, path=None, **kw):
         if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
             raise exc.HTTPNotFound()
         rev = self._commit.url().split('/')[-2]
-        return dict(status=c.app.repo.get_tarball_status(rev, path))
+        result = dict(status=c.app.repo.get_tarball_status(rev, path))
+        if result['status'] == 'busy' and c.app.repo.tarball_in_progress(rev, path):
+            result['stream_url'] = '{}tarball_stream?path={}'.format(
+                self._commit.url(), h.urlquote(path) if path else '')
+        return result
+
+    @expose()
+    def tarball_stream(self, path=None, ext='.zip', **kw):
+        """
+        Sends a snapshot while it is being built, instead of waiting for it.
+
+        The worker serving this is kept busy until the build is done, sleeping
+        while nothing new was written, for up to
+        ``scm.repos.tarball.stream_timeout`` seconds at a time.  If the build
+        fails or stalls, the response is aborted.
+        """
+        if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
+            raise exc.HTTPNotFound()
+        repo = c.app.repo
+        if ext not in repo.tarball_formats:
+            raise exc.HTTPNotFound()
+        rev = self._commit.url().split('/')[-2]
+        fp = None
+        building = repo.tarball_in_progress(rev, path, ext)
+        if building:
+            try:
+                fp = open(building, 'rb')
+            except FileNotFoundError:
+                pass
+        if fp is None:
+            if repo.get_tarball_status(rev, path) == 'complete':
+                redirect(repo.tarball_url(rev, path, ext))
+            raise exc.HTTPNotFound()
+        response.headers['Content-Type'] = ''
+        response.content_type = 'application/zip' if ext == '.zip' else 'application/gzip'
+        response.headers.add(
+            'Content-Disposition',
+            'attachment;filename="%s"' % h.urlquote(repo.tarball_filename(rev, path) + ext))
+        return utils.iter_growing_file(
+            fp, lambda: os.path.exists(building), lambda: repo.tarball_failed(building),
+            timeout=asint(tg.config.get('scm.repos.tarball.stream_timeout', 300)))
 
     @expose('jinja:allura:templates/repo/log.html')
     @with_trailing_slash
@@ -740,6 +740,7 @@ def export(self, tools=None, with_attachments=False):
         return {
             'tools': exportable_tools,
             'status': c.project.bulk_export_status(),
+            'progress': c.project.bulk_export_progress,
             'total_size': round(total_size, 3)
         }
 
@@ -824,7 +825,7 @@ def installable_tools(self, **kw):
 
     @expose('json:')
     @require_post()
-    def export(self, tools=None, send_email=False, with_attachments=False, **kw):
+    def export(self, tools=None, send_email=False, with_attachments=False, incremental=False, **kw):
         """
         Initiate a bulk export of the project data.
 
@@ -839,6 +840,11 @@ def export(self, tools=None, send_email=False, with_attachments=False, **kw):
         If an export is already currently running for this project, a
         `503 Unavailable` response will be returned.
 
+        With `incremental=true`, tools which support it only export what has
+        changed since their last incremental export, and list the ids of
+        artifacts deleted since then.  Their first incremental export is a
+        full one.
+
         Otherwise, a JSON object of the form
         `{"status": "in progress", "filename": FILENAME}` will be returned,
         where `FILENAME` is the filename of the export artifact relative to
@@ -860,7 +866,8 @@ def export(self, tools=None, send_email=False, with_attachments=False, **kw):
         # filename (potentially) includes a timestamp, so we have
         # to pre-generate to be able to return it to the user
         filename = c.project.bulk_export_filename()
-        export_tasks.bulk_export.post(tools, filename, send_email=send_email, with_attachments=with_attachments)
+        export_tasks.bulk_export.post(tools, filename, send_email=send_email, with_attachments=with_attachments,
+                                      incremental=asbool(incremental))
         return {
             'status': 'in progress',
             'filename': filename,
@@ -893,11 +900,14 @@ def export_status(self, **kw):
         """
         Check the status of a bulk export.
 
-        Returns an object containing only one key, `status`, whose value is
-        either `'busy'` or `'ready'`.
+        Returns an object with a `status` key, whose value is either `'busy'`
+        or `'ready'`.  While busy, `progress` maps each tool's mount point to
+        its export state: `'queued'`, `'busy'`, `'done'`, `'failed'` or `'skipped'`.
         """
         status = c.project.bulk_export_status()
-        return {'status': status or 'ready'}
+        if status == 'busy':
+            return {'status': status, 'progress': dict(c.project.bulk_export_progress or {})}
+        return {'status': 'ready'}
 
     @expose('json:')
     @require_post()
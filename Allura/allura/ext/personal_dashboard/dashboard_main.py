@@ -19,10 +19,9 @@
 
 from tg import tmpl_context as c, app_globals as g
 from tg import expose, redirect, config, request
-from itertools import islice
 from ming.odm import session
 
-from allura.model.timeline import perm_check, get_activity_object
+from allura.model.timeline import get_permitted_timeline, get_activity_object
 from allura.controllers import BaseController
 from allura.controllers.feed import FeedController
 from allura.lib.widgets.user_profile import SectionBase, SectionsUtil, ProjectsSectionBase
@@ -146,12 +145,8 @@ def check_display(self):
         return app_installed and activity_enabled
 
     def prepare_context(self, context):
-        full_timeline = g.director.get_timeline(
-            self.user, page=0, limit=100,
-            actor_only=False,
-        )
-        filtered_timeline = list(islice(filter(perm_check(c.user), full_timeline),
-                                        0, 8))
+        filtered_timeline = get_permitted_timeline(
+            self.user, c.user, 8, actor_only=False)[0]
         for activity in filtered_timeline:
             # Get the project for the activity.obj so we can use it in the
             # template. Expunge first so Ming doesn't try to flush the attr
@@ -159,7 +154,7 @@ def prepare_context(self, context):
             #
             # The get_activity_object() calls are cheap, pulling from
             # the session identity map instead of mongo since identical
-            # calls are made by perm_check() above.
+            # calls are made by get_permitted_timeline() above.
             session(activity).expunge(activity)
             activity_obj = get_activity_object(activity.obj)
             activity.obj.project = getattr(activity_obj, 'project', None)
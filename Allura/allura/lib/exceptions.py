@@ -80,6 +80,18 @@ class AddressException(MailError):
     pass
 
 
+class SMTPTransientError(MailError):
+    """A delivery failed in a way that may succeed later.
+
+    ``undelivered`` holds the recipient addresses that were not accepted, so
+    the caller can reschedule delivery for just those.
+    """
+
+    def __init__(self, msg, undelivered=None):
+        super().__init__(msg)
+        self.undelivered = undelivered or []
+
+
 class NoSuchNBFeatureError(ForgeError):
     pass
 
@@ -17,6 +17,7 @@
 
 import re
 import logging
+import time
 import smtplib
 import email.parser
 from email.mime.multipart import MIMEMultipart
@@ -31,7 +32,7 @@
 from tg import tmpl_context as c
 from tg import app_globals as g
 
-from allura.lib.utils import ConfigProxy
+from allura.lib.utils import ConfigProxy, chunked_list
 from allura.lib import exceptions as exc
 from allura.lib import helpers as h
 
@@ -251,13 +252,22 @@ def isvalid(addr):
 
 
 class SMTPClient:
+    """Sends mail over a single SMTP connection which is kept open and reused.
+
+    The connection is checked with a NOOP before use once it has been idle for
+    longer than ``smtp_healthcheck_interval`` seconds, and is dropped on
+    transient errors.  Those errors are not retried here; a
+    :class:`~allura.lib.exceptions.SMTPTransientError` is raised instead so
+    that the calling task can reschedule itself rather than block a worker.
+    """
 
     def __init__(self):
         self._client = None
+        self._last_used = None
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message: EmailMessage,
-            sender=None, references=None, cc=None, to=None):
+            sender=None, references=None, cc=None, to=None, max_recipients=None):
         if not addrs:
             return
         if to:
@@ -295,40 +305,64 @@ def sendmail(
         max_header_len = MAX_MAIL_LINE_OCTETS - (2 + longest_header_len)
 
         content = message.as_string(maxheaderlen=max_header_len)
-        smtp_addrs = list(map(_parse_smtp_addr, addrs))
-        smtp_addrs = [a for a in smtp_addrs if isvalid(a)]
-        if not smtp_addrs:
+        recipients = [(a, _parse_smtp_addr(a)) for a in addrs]
+        recipients = [(a, smtp_a) for a, smtp_a in recipients if isvalid(smtp_a)]
+        if not recipients:
             log.warning('No valid addrs in %s, so not sending mail',
                         list(map(str, addrs)))
             return
 
-        self.send_raw(config.return_path, smtp_addrs, content)
+        # every envelope carries the same content, so large recipient lists are
+        # split into a few envelopes instead of one message per recipient
+        max_recipients = max_recipients or len(recipients)
+        for i, chunk in enumerate(chunked_list(recipients, max_recipients)):
+            try:
+                self.send_raw(config.return_path, [smtp_a for a, smtp_a in chunk], content)
+            except exc.SMTPTransientError as e:
+                remaining = recipients[i * max_recipients:]
+                raise exc.SMTPTransientError(str(e), undelivered=[a for a, smtp_a in remaining])
 
     def send_raw(self, addr_from, smtp_addrs, content):
-        if not self._client:
-            self._connect()
+        self._ensure_connection()
         try:
             self._client.sendmail(
                 addr_from,
                 smtp_addrs,
                 content)
-            need_retry = False
         except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as e:
-            log.info(f'will retry after getting this smtp error: {e!r}')
-            need_retry = True
+            self._disconnect()
+            raise exc.SMTPTransientError(repr(e), undelivered=smtp_addrs)
         except smtplib.SMTPResponseException as e:
             if 400 <= e.smtp_code < 500:  # 4__ is "Transient Negative"
-                log.info(f'will retry after getting this smtp error: {e!r}')
-                need_retry = True
-            else:
-                raise
-        if need_retry:
-            # maybe could sleep?  or if we're in a task, reschedule it somehow?
-            self._connect()
-            self._client.sendmail(
-                addr_from,
-                smtp_addrs,
-                content)
+                self._disconnect()
+                raise exc.SMTPTransientError(repr(e), undelivered=smtp_addrs)
+            raise
+        self._last_used = time.time()
+
+    def _ensure_connection(self):
+        if self._client and self._last_used is not None:
+            idle = time.time() - self._last_used
+            if idle > float(tg.config.get('smtp_healthcheck_interval', 30)):
+                try:
+                    self._client.noop()
+                except (smtplib.SMTPException, OSError) as e:
+                    log.info(f'dropping idle smtp connection after failed health check: {e!r}')
+                    self._disconnect()
+        if not self._client:
+            try:
+                self._connect()
+            except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, OSError) as e:
+                self._disconnect()
+                raise exc.SMTPTransientError(repr(e))
+
+    def _disconnect(self):
+        if self._client:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+        self._client = None
+        self._last_used = None
 
     def _connect(self):
         log.info('connecting to SMTP server')
@@ -351,3 +385,4 @@ def _connect(self):
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
         self._client = smtp_client
+        self._last_used = time.time()
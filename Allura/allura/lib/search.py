@@ -164,9 +164,15 @@ def search(q, short_timeout=False, ignore_errors=True, **kw):
                               (match.group(1) if match else e))
 
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, **kw):
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, facet_queries=None,
+                    **kw):
     """Performs SOLR search.
 
+    :param facet_queries: optional dict of key -> query.  Each query is
+        translated like ``q``, and its count is returned in
+        ``result.facets['facet_queries'][key]``, so many counts can be
+        fetched with one request.
+
     Raises SearchError if SOLR returns an error.
     """
     # first, grab an artifact and get the fields that it indexes
@@ -177,10 +183,15 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
     fq = ['type_s:%s' % fields['type_s']]
     # Now, we'll translate all the fld:
     if c.app is not None:
-        q = atype.translate_query(q, fields)
+        translate = atype.translate_query
         fq.append('mount_point_s:%s' % c.app.config.options.mount_point)
     else:
-        q = SearchIndexable.translate_query(q, fields)
+        translate = SearchIndexable.translate_query
+    q = translate(q, fields)
+    if facet_queries:
+        kw['facet'] = 'true'
+        kw['facet.query'] = ['{!key=%s}%s' % (key, inject_user(translate(fq_q, fields)) or '*:*')
+                             for key, fq_q in facet_queries.items()]
 
     if c.project is not None:
         fq.append('project_id_s:%s' % c.project._id)
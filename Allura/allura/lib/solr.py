@@ -18,6 +18,7 @@
 
 import json
 import logging
+import re
 
 from tg import config
 from webob.exc import HTTPRequestEntityTooLarge
@@ -134,6 +135,7 @@ def search(self, *args, **kw):
 class MockSOLR:
 
     class MockHits(list):
+        facet_queries = None
 
         @property
         def hits(self):
@@ -145,7 +147,10 @@ def docs(self):
 
         @property
         def facets(self):
-            return {'facet_fields': {}}
+            facets = {'facet_fields': {}}
+            if self.facet_queries is not None:
+                facets['facet_queries'] = self.facet_queries
+            return facets
 
     def __init__(self):
         self.db = {}
@@ -168,7 +173,7 @@ def search(self, q, fq=None, **kw):
         if fq:
             q_parts += fq
         for part in q_parts:
-            if part in ('&&', 'AND'):
+            if part in ('&&', 'AND', '*:*'):
                 continue
             if part in ('||', 'OR'):
                 log.warning(f"MockSOLR doesn't implement OR yet; treating as AND. q={q} fq={fq}")
@@ -201,6 +206,13 @@ def search(self, q, fq=None, **kw):
 
         if asbool(kw.get('hl')):
             result.highlighting = {}
+        if asbool(kw.get('facet')) and kw.get('facet.query'):
+            # counts of each {!key=name}query, within the main query's filters
+            result.facet_queries = {}
+            for facet_q in kw['facet.query']:
+                match = re.match(r'{!key=([^}]*)}(.*)', facet_q)
+                key, facet_q = match.groups() if match else (facet_q, facet_q)
+                result.facet_queries[key] = len(self.search(facet_q, fq=fq))
         return result
 
     def delete(self, *args, **kwargs):
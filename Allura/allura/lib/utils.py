@@ -26,6 +26,7 @@
 import logging.handlers
 import os.path
 import datetime
+import email.utils
 import random
 import mimetypes
 import re
@@ -34,12 +35,15 @@
 from itertools import groupby
 import operator as op
 import collections
+import bson
 import ming
+import pymongo
 from urllib.parse import urlparse
 import six.moves.urllib.request
 import six.moves.urllib.parse
 import six.moves.urllib.error
 import socket
+import uuid
 
 import tg
 import emoji
@@ -193,6 +197,83 @@ def chunked_find(cls: type[T], query: dict | None = None, pagesize: int = 1024,
         page += 1
 
 
+def _keyset_values(obj, sort):
+    values = []
+    for key, direction in sort:
+        value = obj
+        for part in key.split('.'):
+            if isinstance(value, Mapping):
+                value = value.get(part)
+            else:
+                value = getattr(value, part, None)
+        values.append(value)
+    return values
+
+
+def _decode_keyset_token(token):
+    try:
+        return bson.decode(base64.urlsafe_b64decode(token.encode('ascii')))['values']
+    except Exception:
+        raise ValueError(f'Invalid page token: {token!r}')
+
+
+def keyset_sort(sort, unique='_id'):
+    """
+    Return ``sort`` (a list of (field, direction) pairs) with the ``unique``
+    key added last, unless it is sorted on already, so that no two documents
+    tie.  ``unique`` must be unique among the documents listed, e.g.
+    ``ticket_num`` within a tracker.  It is added in the direction of the
+    last key, so an index on the sort keys followed by ``unique`` serves the
+    sort.  Listings paged with :func:`keyset_token` and :func:`keyset_query`
+    must be sorted by it.
+    """
+    sort = list(sort)
+    if unique not in [key for key, direction in sort]:
+        sort.append((unique, sort[-1][1] if sort else pymongo.ASCENDING))
+    return sort
+
+
+def keyset_token(items, sort):
+    """
+    Return an opaque token for continuing a listing of ``items``, sorted by
+    ``sort`` (from :func:`keyset_sort`), after its last item.
+    """
+    items = list(items)
+    if not items:
+        return None
+    token = bson.encode({'values': _keyset_values(items[-1], sort)})
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+
+def keyset_query(query, sort, after):
+    """
+    Return ``query`` restricted to the documents which follow the ``after``
+    token (from :func:`keyset_token`) in ``sort`` order (from
+    :func:`keyset_sort`), so pages after the first can be found without
+    skipping over the ones before them.
+
+    Raises ValueError for an invalid token.
+    """
+    values = _decode_keyset_token(after)
+    if len(values) != len(sort):
+        raise ValueError(f'Invalid page token: {after!r}')
+    clauses = []
+    equal = {}
+    for (key, direction), value in zip(sort, values):
+        if direction == pymongo.ASCENDING:
+            # nulls sort first
+            after_value = {'$gt': value} if value is not None else {'$ne': None}
+            clauses.append(dict(equal, **{key: after_value}))
+        elif value is not None:
+            # nulls sort last
+            clauses.append(dict(equal, **{key: {'$lt': value}}))
+            clauses.append(dict(equal, **{key: None}))
+        equal[key] = value
+    if '$or' in query:
+        return {'$and': [query, {'$or': clauses}]}
+    return dict(query, **{'$or': clauses})
+
+
 def chunked_list(l, n):
     """ Yield successive n-sized chunks from l.
     """
@@ -515,21 +596,149 @@ def take_while_true(source):
         x = source()
 
 
+# more ranges than this in one request are not worth the overhead, and may be abusive
+MAX_HTTP_RANGES = 20
+
+
+def http_ranges(range_header, size):
+    """
+    Parse a ``Range: bytes=...`` request header for a file of ``size`` bytes
+    into a sorted list of (start, stop) offsets, with overlapping and adjacent
+    ranges merged.  Returns None if the header is to be ignored (and the whole
+    file served, as it is when the ranges cover all of it), or an empty list
+    if none of the ranges can be satisfied.
+    """
+    units, _, spec = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    parts = spec.split(',')
+    if len(parts) > MAX_HTTP_RANGES:
+        return None
+    ranges = []
+    for part in parts:
+        first, sep, last = part.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                # suffix range: the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                start, stop = max(size - length, 0), size
+                if not length:
+                    continue
+            else:
+                start, stop = int(first), size
+                if last:
+                    stop = int(last) + 1
+                    if stop <= start:
+                        return None
+                if start < 0:
+                    return None
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(stop, size)))
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    if merged == [(0, size)]:
+        return None
+    return merged
+
+
+def _iter_range(fp, start, stop, block_size):
+    fp.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = fp.read(min(block_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def iter_growing_file(fp, is_growing, has_failed=None, block_size=None, poll_secs=1, timeout=300):
+    """Yields the contents of ``fp`` while it is being written, until
+    ``is_growing()`` is false.
+
+    This keeps a worker sleeping for as long as the writer takes, and up to
+    ``timeout`` seconds after the last write.  If nothing was written for that
+    long, or ``has_failed()`` is true once it stopped growing, an error is
+    raised, so the response is aborted rather than ending as if complete.
+    """
+    if block_size is None:
+        block_size = asint(tg.config.get('files_block_size', 64 * 1024))
+    name = getattr(fp, 'name', fp)
+    idle = 0
+    with fp:
+        while True:
+            data = fp.read(block_size)
+            if data:
+                idle = 0
+                yield data
+            elif not is_growing():
+                if has_failed and has_failed():
+                    raise OSError(f'Writing {name} failed')
+                # the rest was written before it stopped growing
+                yield from iter(lambda: fp.read(block_size), b'')
+                return
+            elif idle >= timeout:
+                raise OSError(f'Gave up waiting for {name} to grow')
+            else:
+                time.sleep(poll_secs)
+                idle += poll_secs
+
+
+def _http_date_matches(value, last_modified):
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return False
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date == _http_datetime(last_modified)
+
+
+def _http_datetime(dt):
+    """HTTP dates are UTC, to the second"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.replace(microsecond=0)
+
+
 def serve_file(fp, filename, content_type, last_modified=None,
-               cache_expires=None, size=None, embed=True, etag=None):
-    '''Sets the response headers and serves as a wsgi iter'''
+               cache_expires=None, size=None, embed=True, etag=None, offload=None):
+    '''Sets the response headers and serves as a wsgi iter
+
+    ``fp`` may be a function returning the file, so it isn't opened for
+    conditional requests answered with 304 Not Modified.  Byte ranges are
+    served (by seeking) for files which support it.
+
+    If ``files.offload_header`` and ``files.offload_dir`` are both configured,
+    ``offload`` may be a function taking that directory and returning the path
+    of a copy of the file there.  The front-end web server is then told to send
+    that copy, instead of it being sent from here.
+    '''
     if not etag and filename and last_modified:
         # must be latin1, no unicode
         etag = filename.encode("latin1", "backslashreplace").decode('latin1') + f'?{last_modified}'
     if etag:
         etag_cache(etag)
+    if (isinstance(last_modified, datetime.datetime) and tg.request.if_modified_since
+            and 'HTTP_IF_NONE_MATCH' not in tg.request.environ
+            and _http_datetime(last_modified) <= tg.request.if_modified_since):
+        raise exc.HTTPNotModified()
     tg.response.headers['Content-Type'] = ''
     tg.response.content_type = str(content_type)
     tg.response.cache_expires = cache_expires or asint(
         tg.config.get('files_expires_header_secs', 60 * 60))
     tg.response.last_modified = last_modified
-    if size:
-        tg.response.content_length = size
     if 'Pragma' in tg.response.headers:
         del tg.response.headers['Pragma']
     if 'Cache-Control' in tg.response.headers:
@@ -539,8 +748,68 @@ def serve_file(fp, filename, content_type, last_modified=None,
         tg.response.headers.add(
             'Content-Disposition',
             'attachment;filename="%s"' % h.urlquote(filename))
+    offload_header = tg.config.get('files.offload_header')
+    offload_dir = tg.config.get('files.offload_dir')
+    if offload is not None and offload_header and offload_dir:
+        path = offload(offload_dir)
+        if offload_header.lower() == 'x-accel-redirect':
+            # an internal location of the web server, serving offload_dir
+            location = tg.config.get('files.offload_location', '/_files/')
+            path = location.rstrip('/') + '/' + six.moves.urllib.parse.quote(os.path.relpath(path, offload_dir))
+        tg.response.headers[offload_header] = path
+        return []
+    if callable(fp):
+        fp = fp()
+    seekable = getattr(fp, 'seekable', lambda: False)()
+    if size is None and seekable:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(0)
+    if size:
+        tg.response.content_length = size
+    block_size = asint(tg.config.get('files_block_size', 64 * 1024))
+
+    ranges = None
+    if seekable and size is not None:
+        tg.response.headers['Accept-Ranges'] = 'bytes'
+        range_header = tg.request.headers.get('Range')
+        if_range = tg.request.headers.get('If-Range')
+        if range_header and (not if_range
+                             or if_range == f'"{etag}"'
+                             or (last_modified and _http_date_matches(if_range, last_modified))):
+            ranges = http_ranges(range_header, size)
+    if ranges == []:
+        tg.response.status = 416
+        tg.response.headers['Content-Range'] = f'bytes */{size}'
+        tg.response.content_length = 0
+        return []
+    if ranges and len(ranges) == 1:
+        start, stop = ranges[0]
+        tg.response.status = 206
+        tg.response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        tg.response.content_length = stop - start
+        return _iter_range(fp, start, stop, block_size)
+    if ranges:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, stop in ranges:
+            part_headers = (f'\r\n--{boundary}\r\n'
+                            f'Content-Type: {content_type}\r\n'
+                            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('latin1')
+            parts.append((part_headers, start, stop))
+        closing = f'\r\n--{boundary}--\r\n'.encode('latin1')
+        tg.response.status = 206
+        tg.response.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        tg.response.content_length = sum(len(ph) + stop - start for ph, start, stop in parts) + len(closing)
+
+        def multipart():
+            for part_headers, start, stop in parts:
+                yield part_headers
+                yield from _iter_range(fp, start, stop, block_size)
+            yield closing
+        return multipart()
+
     # http://code.google.com/p/modwsgi/wiki/FileWrapperExtension
-    block_size = 4096
     if 'wsgi.file_wrapper' in tg.request.environ:
         return tg.request.environ['wsgi.file_wrapper'](fp, block_size)
     else:
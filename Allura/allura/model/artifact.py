@@ -25,7 +25,7 @@
 from tg import tmpl_context as c, app_globals as g
 from tg import request
 from ming import schema as S
-from ming.odm import state, session
+from ming.odm import state, session, mapper
 from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.odm.declarative import MappedClass
 from ming.utils import LazyProperty
@@ -39,6 +39,7 @@
 from allura.lib.decorators import memoize
 from allura.lib.search import SearchIndexable
 from .session import main_orm_session
+from .session import ManagedSessionExtension
 from .session import project_orm_session
 from .session import artifact_orm_session
 from .index import ArtifactReference, Shortlink
@@ -110,6 +111,8 @@ def before_save(data):
     # the artifact came from.  But if you only have one source, a str might do.
     import_id = FieldProperty(None, if_missing=None)
     deleted = FieldProperty(bool, if_missing=False)
+    # discussion thread preloaded by Application.bulk_export_chunks
+    _export_thread = None
 
     def __json__(self, posts_limit=None, is_export=False, user=None):
         """Return a JSON-encodable :class:`dict` representation of this
@@ -441,6 +444,8 @@ def discussion_thread(self):
         for this Artifact.
 
         """
+        if self._export_thread is not None:
+            return self._export_thread
         return self.get_discussion_thread()[0]
 
     def add_multiple_attachments(self, file_info):
@@ -504,6 +509,43 @@ def delete(self):
         session(self).flush(self)
         session(self).imap.expunge(self)
 
+    @classmethod
+    def save_many(cls, artifacts):
+        '''Save new and edited artifacts with one ``insert_many`` and one
+        ``bulk_write`` per collection, rather than one write each when the
+        session is flushed.  Artifact references, shortlinks and index updates
+        are queued as a flush would have done.'''
+        added, modified = [], []
+        for artifact in artifacts:
+            st = state(artifact)
+            if st.status == st.new:
+                added.append(artifact)
+            elif st.status == st.dirty:
+                modified.append(artifact)
+        if not (added or modified):
+            return
+        inserts, updates = defaultdict(list), defaultdict(list)
+        for artifact in added + modified:
+            collection = mapper(artifact).collection
+            doc = collection(state(artifact).document, skip_from_bson=True)
+            if doc.m.before_save:
+                doc.m.before_save(doc)
+            data = dict(doc)
+            if state(artifact).status == state(artifact).new:
+                inserts[collection].append(data)
+            else:
+                updates[collection].append(pymongo.UpdateOne({'_id': data.pop('_id')}, {'$set': data}))
+        for collection, docs in inserts.items():
+            collection.m.collection.insert_many(docs)
+        for collection, requests in updates.items():
+            collection.m.collection.bulk_write(requests, ordered=False)
+        for ext in session(cls).extensions:
+            if isinstance(ext, ManagedSessionExtension):
+                ext.objects_added, ext.objects_modified, ext.objects_deleted = added, modified, []
+                ext.after_flush()
+        for artifact in added + modified:
+            state(artifact).status = state(artifact).clean
+
     def get_mail_footer(self, notification, toaddr):
         allow_email_posting = self.app.config.options.get('AllowEmailPosting', True)
         return MailFooter.standard(notification, allow_email_posting)
@@ -627,13 +669,12 @@ class __mongometa__:
 
     version = FieldProperty(S.Int, if_missing=0)
 
-    def commit(self, update_stats=True):
-        '''Save off a snapshot of the artifact and increment the version #'''
+    def _snapshot_data(self):
         try:
             ip_address = utils.ip_address(request)
         except Exception:
             ip_address = '0.0.0.0'
-        data = dict(
+        return dict(
             artifact_id=self._id,
             artifact_class='{}.{}'.format(
                 self.__class__.__module__,
@@ -644,6 +685,18 @@ def commit(self, update_stats=True):
                 display_name=c.user.get_pref('display_name'),
                 logged_ip=ip_address),
             data=state(self).clone())
+
+    def _update_commit_stats(self):
+        if self.version > 1:
+            g.statsUpdater.modifiedArtifact(
+                self.type_s, self.mod_date, self.project, c.user)
+        else:
+            g.statsUpdater.newArtifact(
+                self.type_s, self.mod_date, self.project, c.user)
+
+    def commit(self, update_stats=True):
+        '''Save off a snapshot of the artifact and increment the version #'''
+        data = self._snapshot_data()
         while True:
             self.version += 1
             data['version'] = self.version
@@ -661,14 +714,41 @@ def commit(self, update_stats=True):
         log.debug('Snapshot version %s of %s',
                   self.version, self.__class__)
         if update_stats:
-            if self.version > 1:
-                g.statsUpdater.modifiedArtifact(
-                    self.type_s, self.mod_date, self.project, c.user)
-            else:
-                g.statsUpdater.newArtifact(
-                    self.type_s, self.mod_date, self.project, c.user)
+            self._update_commit_stats()
         return ss
 
+    @classmethod
+    def commit_many(cls, artifacts, update_stats=True):
+        '''Same as calling :meth:`commit` on each artifact, but the snapshots
+        are saved with a single insert.  Returns the snapshots.'''
+        artifacts = list(artifacts)
+        history_class = cls.__mongometa__.history_class
+        snapshots = []
+        for artifact in artifacts:
+            data = artifact._snapshot_data()
+            artifact.version += 1
+            ss = history_class(version=artifact.version, timestamp=datetime.utcnow(), **data)
+            session(ss).expunge(ss)
+            snapshots.append(ss)
+        if snapshots:
+            collection = mapper(history_class).collection
+            try:
+                collection.m.collection.insert_many(
+                    [collection.make(state(ss).document) for ss in snapshots], ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # some versions were taken by concurrent edits, commit those
+                # one at a time so they get the next free version
+                for error in e.details['writeErrors']:
+                    artifact = artifacts[error['index']]
+                    log.warning('Trying to create duplicate version %s of %s',
+                                artifact.version, artifact.__class__)
+                    artifact.version -= 1
+                    snapshots[error['index']] = VersionedArtifact.commit(artifact, update_stats=False)
+        if update_stats:
+            for artifact in artifacts:
+                artifact._update_commit_stats()
+        return snapshots
+
     def get_version(self, n):
         if n < 0:
             n = self.version + n + 1
@@ -925,20 +1005,25 @@ class Feed(MappedClass):
     class __mongometa__:
         session = project_orm_session
         name = 'artifact_feed'
+        # feeds sort on pubdate, with _id as a tiebreaker (see Feed.feed)
         indexes = [
-            'pubdate',
+            ('pubdate', '_id'),
             ('artifact_ref.project_id', 'artifact_ref.mount_point'),
             (('ref_id', pymongo.ASCENDING),
-             ('pubdate', pymongo.DESCENDING)),
+             ('pubdate', pymongo.DESCENDING),
+             ('_id', pymongo.DESCENDING)),
             (('project_id', pymongo.ASCENDING),
              ('app_config_id', pymongo.ASCENDING),
-             ('pubdate', pymongo.DESCENDING)),
+             ('pubdate', pymongo.DESCENDING),
+             ('_id', pymongo.DESCENDING)),
             # used in ext/user_profile/user_main.py for user feeds
             (('author_link', pymongo.ASCENDING),
-             ('pubdate', pymongo.DESCENDING)),
+             ('pubdate', pymongo.DESCENDING),
+             ('_id', pymongo.DESCENDING)),
             # used in project feed
             (('project_id', pymongo.ASCENDING),
-             ('pubdate', pymongo.DESCENDING)),
+             ('pubdate', pymongo.DESCENDING),
+             ('_id', pymongo.DESCENDING)),
         ]
 
     query: 'Query[Feed]'
@@ -1025,10 +1110,45 @@ def post(cls, artifact, title=None, description=None, author=None,
             item.unique_id = unique_id
         return item
 
+    @classmethod
+    def post_many(cls, artifacts, title, description, author=None, pubdate=None, link=None):
+        """
+        Create one Feed item for a change made to several artifacts of the
+        same tool at once, e.g. a bulk edit.  Callers should leave out the
+        artifacts anon can't read (see :meth:`has_access`).  Returns the item,
+        or None if there are no artifacts.
+        """
+        artifacts = list(artifacts)
+        if not artifacts:
+            return
+        app_config = artifacts[0].app_config
+        if author is None:
+            author = c.user
+        if pubdate is None:
+            pubdate = datetime.utcnow()
+        if link is None:
+            link = app_config.url()
+        return cls(
+            ref_id=None,
+            neighborhood_id=app_config.project.neighborhood_id,
+            project_id=app_config.project_id,
+            app_config_id=app_config._id,
+            tool_name=app_config.tool_name,
+            title=title,
+            description=g.markdown.convert(description),
+            link=link,
+            pubdate=pubdate,
+            author_name=author.get_pref('display_name'),
+            author_link=author.url())
+
     @classmethod
     def feed(cls, q, feed_type, title, link, description,
-             since=None, until=None, page=None, limit=None):
-        "Produces feedgenerator Feed"
+             since=None, until=None, page=None, limit=None, after=None):
+        """Produces feedgenerator Feed
+
+        Pages after the first can be found by ``page``, or more cheaply by
+        ``after``: the ``next_after`` token of the previous page's feed.
+        """
         d = dict(title=title, link=h.absurl(h.urlquote(link)),
                  description=description, language='en',
                  feed_url=request.url)
@@ -1039,17 +1159,22 @@ def feed(cls, q, feed_type, title, link, description,
         limit, page = h.paging_sanitizer(limit or 10, page)
         query = defaultdict(dict)
         if callable(q):
-            q = q(since, until, page, limit)
+            q = q(since, until, page, limit, after=after)
         query.update(q)
         if since is not None:
             query['pubdate']['$gte'] = since
         if until is not None:
             query['pubdate']['$lte'] = until
+        sort = utils.keyset_sort([('pubdate', pymongo.DESCENDING)])
+        if after:
+            query = utils.keyset_query(dict(query), sort, after)
+            page = 0
         cur = cls.query.find(query)
-        cur = cur.sort('pubdate', pymongo.DESCENDING)
+        cur = cur.sort(sort)
         cur = cur.limit(limit)
         cur = cur.skip(limit * page)
-        for r in cur:
+        entries = cur.all()
+        for r in entries:
             feed.add_item(title=r.title,
                           link=h.absurl(h.urlquote_path_only(r.link)),
                           pubdate=r.pubdate,
@@ -1057,6 +1182,7 @@ def feed(cls, q, feed_type, title, link, description,
                           unique_id=h.absurl(r.unique_id),
                           author_name=r.author_name,
                           author_link=h.absurl(r.author_link))
+        feed.next_after = utils.keyset_token(entries, sort) if len(entries) == limit else None
         return feed
 
 
@@ -17,6 +17,7 @@
 from __future__ import annotations
 import os
 import logging
+from collections import defaultdict
 from datetime import datetime
 import typing
 
@@ -42,7 +43,7 @@
 from .artifact import Artifact, ArtifactReference, VersionedArtifact, Snapshot, Message, Feed, ReactableArtifact
 from .attachments import BaseAttachment
 from .auth import User, ProjectRole, AlluraUserProperty
-from .timeline import ActivityObject
+from .timeline import ActivityObject, security_context_key
 from .types import MarkdownCache
 
 if typing.TYPE_CHECKING:
@@ -185,6 +186,8 @@ class __mongometa__:
 
     discussion = RelationProperty(Discussion)
     posts = RelationProperty('Post', via='thread_id')
+    # visible posts preloaded by Application.bulk_export_chunks
+    _export_posts = None
     first_post = RelationProperty('Post', via='first_post_id')
     ref = RelationProperty('ArtifactReference')
 
@@ -213,8 +216,20 @@ def attachments_for_json(self, page):
         return [dict(bytes=attach.length,
                      url=h.absurl(attach.url())) for attach in page.attachments]
 
-    def __json__(self, limit=None, page=None, is_export=False):
-        return dict(
+    def export_posts(self):
+        """All visible posts, oldest first, as included in bulk exports"""
+        if self._export_posts is not None:
+            return self._export_posts
+        return self.query_posts(status='ok', style='chronological')
+
+    def __json__(self, limit=None, page=None, is_export=False, after=None):
+        paged = limit is not None or page is not None or after is not None
+        if not paged:
+            posts = self.export_posts()
+        else:
+            posts = self.query_posts(status='ok', style='chronological', limit=limit, page=page,
+                                     after=after).all()
+        result = dict(
             _id=self._id,
             discussion_id=str(self.discussion_id),
             subject=self.subject,
@@ -230,9 +245,12 @@ def __json__(self, limit=None, page=None, is_export=False):
                         attachments=self.attachment_for_export(p) if is_export else self.attachments_for_json(p),
                         is_meta=p.is_meta,
                         )
-                   for p in self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+                   for p in posts
                    ]
         )
+        if paged:
+            result['next'] = utils.keyset_token(posts, self.posts_sort('chronological'))
+        return result
 
     @property
     def activity_name(self):
@@ -375,6 +393,65 @@ def post(self, text, message_id=None, parent_id=None, notify=True,
             self.notify_moderators(post)
         return post
 
+    @classmethod
+    def post_meta_many(cls, changes):
+        '''Post a meta comment, such as a changelog, on the discussion thread
+        of each artifact in ``changes``, a list of ``(artifact, text)`` pairs.
+        Same as ``artifact.discussion_thread.post(text, notify=False,
+        is_meta=True)`` for each, but the threads are read with one query and
+        the posts, their snapshots and the thread counters are saved in bulk.
+        Returns the posts.'''
+        changes = list(changes)
+        found = defaultdict(list)
+        for thread in cls.query.find({'ref_id': {'$in': [a.index_id() for a, text in changes]}}):
+            found[thread.ref_id].append(thread)
+        author = c.user
+        author_role = ProjectRole.by_user(author, upsert=True)
+        result, posts, threads = [], defaultdict(list), {}
+        for artifact, text in changes:
+            thread = found[artifact.index_id()]
+            # artifact.discussion_thread also merges duplicate threads
+            thread = thread[0] if len(thread) == 1 else artifact.discussion_thread
+            require_access(thread, 'post')
+            if not has_access(thread, 'unmoderated_post'):
+                result.append(thread.post(text, notify=False, is_meta=True))
+                continue
+            slug, full_slug = thread.post_class().make_slugs()
+            post = thread.post_class()(
+                _id=h.gen_message_id(),
+                discussion_id=thread.discussion_id,
+                full_slug=full_slug,
+                slug=slug,
+                thread_id=thread._id,
+                text=text,
+                status='ok',
+                is_meta=True)
+            if not author.is_anonymous():
+                security.simple_grant(post.acl, author_role._id, 'moderate')
+            posts[type(post)].append(post)
+            threads[thread._id] = (thread, artifact)
+            result.append(post)
+        for post_class, batch in posts.items():
+            post_class.commit_many(batch)
+            if (c.app.config.options.get('PostingPolicy') == 'ApproveOnceModerated'
+                    and author._id is not None):
+                for post in batch:
+                    security.simple_grant(post.acl, author_role._id, 'unmoderated_post')
+            post_class.save_many(batch)
+            num_replies = {row['_id']: row['count'] for row in post_class.query.aggregate([
+                {'$match': {'thread_id': {'$in': [p.thread_id for p in batch]}, 'status': 'ok', 'deleted': False}},
+                {'$group': {'_id': '$thread_id', 'count': {'$sum': 1}}},
+            ])}
+            for post in batch:
+                thread, artifact = threads[post.thread_id]
+                thread.last_post_date = max(thread.last_post_date, post.mod_date)
+                thread.num_replies = num_replies.get(thread._id, 0)
+        cls.save_many([thread for thread, artifact in threads.values()])
+        for thread, artifact in threads.values():
+            if hasattr(artifact, 'update_stats'):
+                artifact.update_stats()
+        return result
+
     def notify_moderators(self, post):
         ''' Notify moderators that a post needs approval [#2963] '''
         artifact = self.artifact or self
@@ -429,8 +506,19 @@ def create_post_threads(self, posts):
                 result.append(pi)
         return result
 
+    @staticmethod
+    def posts_sort(style='threaded'):
+        if style == 'threaded':
+            # full_slug is unique within a thread
+            return utils.keyset_sort([('full_slug', pymongo.ASCENDING)], unique='full_slug')
+        return utils.keyset_sort([('timestamp', pymongo.ASCENDING)])
+
     def query_posts(self, page=None, limit=None,
-                    timestamp=None, style='threaded', status=None):
+                    timestamp=None, style='threaded', status=None, after=None):
+        """Query the thread's posts.  Pages after the first can be found by
+        ``page``, or more cheaply by ``after``: a token from
+        :func:`allura.lib.utils.keyset_token` for the last post of the
+        previous page (with the same ``style``)."""
         if timestamp:
             terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
                          status={'$in': ['ok', 'pending']}, timestamp=timestamp)
@@ -440,14 +528,14 @@ def query_posts(self, page=None, limit=None,
         if status:
             terms['status'] = status
         terms['deleted'] = False
+        sort = self.posts_sort(style)
+        if after:
+            terms = utils.keyset_query(terms, sort, after)
         q = self.post_class().query.find(terms)
-        if style == 'threaded':
-            q = q.sort('full_slug')
-        else:
-            q = q.sort('timestamp')
+        q = q.sort(sort)
         if limit is not None:
             limit = int(limit)
-            if page is not None:
+            if page is not None and not after:
                 q = q.skip(page * limit)
             q = q.limit(limit)
         return q
@@ -534,6 +622,8 @@ class __mongometa__:
             ('thread_id', 'status', 'deleted'),
             # for find_posts/query_posts, including full_slug sort which is useful on super big threads
             ('deleted', 'discussion_id', 'thread_id', 'full_slug'),
+            # for query_posts' chronological sort, see posts_sort()
+            ('deleted', 'discussion_id', 'thread_id', 'timestamp', '_id'),
         ]
 
     query: 'Query[Post]'
@@ -600,6 +690,22 @@ def has_activity_access(self, perm, user, activity):
         return artifact_access and security.has_access(self, perm, user,
                                                        self.project)
 
+    def activity_access_key(self, activity):
+        if self.project is None or self.deleted or self.status != 'ok':
+            return None
+        artifact_key = None
+        artifact = self.thread.artifact
+        if artifact:
+            if artifact.project is None or artifact.deleted:
+                return None
+            artifact_key = security_context_key(artifact)
+            if artifact_key is None:
+                return None
+        post_key = security_context_key(self)
+        if post_key is None:
+            return None
+        return ('Post', post_key, artifact_key)
+
     @property
     def activity_extras(self):
         d = ActivityObject.activity_extras.fget(self)
@@ -712,28 +818,17 @@ def url_paginated(self):
         if not self.thread:  # pragma no cover
             return None
         limit, p, s = g.handle_paging(None, 0)  # get paging limit
-        if self.query.find(dict(thread_id=self.thread._id)).count() <= limit:
-            # all posts in a single page
-            page = 0
-        else:
-            posts = self.thread.find_posts()
-            posts = self.thread.create_post_threads(posts)
-
-            def find_i(posts):
-                '''Find the index number of this post in the display order'''
-                q = []
-
-                def traverse(posts):
-                    for p in posts:
-                        if p['post']._id == self._id:
-                            return True  # found
-                        q.append(p)
-                        if traverse(p['children']):
-                            return True
-                traverse(posts)
-                return len(q)
-
-            page = find_i(posts) // limit
+        # the threaded view pages through the posts sorted by full_slug (which
+        # puts replies right after their parent), so the number of posts
+        # sorting before this one is its index in the display order
+        index = self.query.find(dict(
+            discussion_id=self.thread.discussion_id,
+            thread_id=self.thread._id,
+            status={'$in': ['ok', 'pending']},
+            deleted=False,
+            full_slug={'$lt': self.full_slug},
+        )).count()
+        page = index // limit
 
         slug = h.urlquote(self.slug)
         url = self.main_url()
@@ -17,6 +17,8 @@
 
 import os
 import re
+import shutil
+import tempfile
 from io import BytesIO
 import logging
 import typing
@@ -27,6 +29,7 @@
 from ming import schema
 from ming.odm import session, FieldProperty
 from ming.odm.declarative import MappedClass
+from tg import config
 
 from .session import project_orm_session
 from allura.lib import utils
@@ -111,6 +114,12 @@ def from_data(cls, filename, data, **kw):
 
     def delete(self):
         self._fs().delete(self.file_id)
+        offload_dir = config.get('files.offload_dir')
+        if offload_dir and self.file_id:
+            try:
+                os.remove(self._offload_path(offload_dir))
+            except FileNotFoundError:
+                pass
         super().delete()
 
     def rfile(self):
@@ -125,11 +134,35 @@ def wfile(self):
 
     def serve(self, embed=True):
         '''Sets the response headers and serves as a wsgi iter'''
-        gridfs_file = self.rfile()
-        return utils.serve_file(gridfs_file, self.filename, self.content_type,
+        # opened only if the request isn't answered with 304 Not Modified
+        return utils.serve_file(self.rfile, self.filename, self.content_type,
                                 last_modified=self._id.generation_time,
-                                size=gridfs_file.length,
-                                embed=embed)
+                                embed=embed, offload=self.offload_copy)
+
+    def _offload_path(self, offload_dir):
+        # GridFS files are never changed, a new one is written instead, so a
+        # copy named after the GridFS id is always current
+        name = str(self.file_id)
+        return os.path.join(offload_dir, name[-2:], name)
+
+    def offload_copy(self, offload_dir):
+        """Return the path of a copy of this file in ``offload_dir``, for the
+        front-end web server to send.  It is copied from GridFS on first use."""
+        path = self._offload_path(offload_dir)
+        if not os.path.exists(path):
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    shutil.copyfileobj(self.rfile(), fp, 1024 * 1024)
+                os.chmod(tmp_path, 0o644)
+                # readers never see a partial copy
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        return path
 
     @classmethod
     def save_thumbnail(cls, filename, image,
@@ -281,6 +281,7 @@ class __mongometa__:
     is_nbhd_project = FieldProperty(bool, if_missing=False)
     features = FieldProperty([str])
     rating = FieldProperty(float, if_missing=0)
+    bulk_export_progress = FieldProperty({str: str})  # mount point: export state
 
     # transient properties
     notifications_disabled = False
@@ -1210,7 +1211,8 @@ def bulk_export_status(self):
         Returns 'busy' if an export is queued or in-progress.  Returns None otherwise
         '''
         q = {
-            'task_name': 'allura.tasks.export_tasks.bulk_export',
+            'task_name': {'$in': ['allura.tasks.export_tasks.bulk_export',
+                                  'allura.tasks.export_tasks.bulk_export_tool']},
             'state': {'$in': ['busy', 'ready']},
             'context.project_id': self._id,
         }
@@ -1220,6 +1222,36 @@ def bulk_export_status(self):
         else:
             return 'busy'
 
+    def set_bulk_export_progress(self, tool, status, expect=None):
+        '''
+        Atomically record the export ``status`` of one tool ('queued', 'busy', 'done',
+        'failed' or 'skipped') so that concurrent export tasks don't overwrite each other.
+
+        :param expect: only update if the tool is currently in this state
+        :return: the updated progress, or None if ``expect`` didn't match
+        '''
+        query = {'_id': self._id}
+        if expect is not None:
+            query['bulk_export_progress.' + tool] = expect
+        project = self.__class__.query.find_and_modify(
+            query=query,
+            update={'$set': {'bulk_export_progress.' + tool: status}},
+            new=True)
+        if project is None:
+            return None
+        return dict(project.bulk_export_progress)
+
+    def clear_bulk_export_progress(self):
+        '''
+        Remove the export progress.  Returns True for only one caller even if several
+        tasks race to clear it, so that caller can finish the export.
+        '''
+        project = self.__class__.query.find_and_modify(
+            query={'_id': self._id, 'bulk_export_progress': {'$exists': True}},
+            update={'$unset': {'bulk_export_progress': 1}},
+            new=True)
+        return project is not None
+
     def index(self):
         provider = plugin.ProjectRegistrationProvider.get()
         try:
@@ -1422,6 +1454,7 @@ class __mongometa__:
     project = RelationProperty(Project, via='project_id')
     discussion = RelationProperty('Discussion', via='discussion_id')
     tool_data = FieldProperty({str: {str: None}})  # entry point: prefs dict
+    bulk_export_mark = FieldProperty(datetime, if_missing=None)  # when the last incremental export started
 
     acl = FieldProperty(ACL())
 
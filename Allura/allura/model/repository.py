@@ -342,6 +342,14 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         """
         raise NotImplementedError('paged_diffs')
 
+    def commit_line_stats(self, commit_id):
+        """
+        Return the number of lines added and removed by a given commit (compared
+        to its first parent) in each file it touched, as a list of dicts with
+        `path`, `added` and `removed`.  The counts are None for binary files.
+        """
+        raise NotImplementedError('commit_line_stats')
+
     def merge_request_commits(self, mr):
         """Given MergeRequest :param mr: return list of commits to be merged"""
         raise NotImplementedError('merge_request_commits')
@@ -418,14 +426,24 @@ def tarball_tmpdir(self):
                             self.project.shortname,
                             self.name)
 
+    @property
+    def tarball_snapshot_dir(self):
+        """Holds the archives shared by the revisions with the same tree"""
+        return os.path.join(self.tarball_path, 'snapshots')
+
+    @property
+    def tarball_formats(self):
+        """Extensions of the archives built for each snapshot"""
+        return ['.zip']
+
     def tarball_filename(self, revision, path=None):
         shortname = c.project.shortname.replace('/', '-')
         mount_point = c.app.config.options.mount_point
         filename = f'{shortname}-{mount_point}-{revision}'
         return filename
 
-    def tarball_url(self, revision, path=None):
-        filename = '{}{}'.format(self.tarball_filename(revision, path), '.zip')
+    def tarball_url(self, revision, path=None, ext='.zip'):
+        filename = '{}{}'.format(self.tarball_filename(revision, path), ext)
         r = os.path.join(self.tool,
                          self.project.shortname[:1],
                          self.project.shortname[:2],
@@ -439,6 +457,12 @@ def get_tarball_status(self, revision, path=None):
             self.tarball_path, self.tarball_filename(revision, path))
         filename = '{}{}'.format(pathname, '.zip')
         if os.path.isfile(filename.encode('utf-8')):
+            # record the use, for prune_tarballs
+            for ext in self.tarball_formats:
+                try:
+                    os.utime(f'{pathname}{ext}'.encode('utf-8'))
+                except OSError:
+                    pass
             return 'complete'
 
         # file doesn't exist, check for busy task
@@ -450,6 +474,53 @@ def get_tarball_status(self, revision, path=None):
 
         return task.state if task else None
 
+    def tarball_in_progress(self, revision, path=None, ext='.zip'):
+        """Path of the archive currently being built for the revision, if it
+        can be read while it is written, otherwise None"""
+        return None
+
+    def tarball_failed(self, tmpfilename):
+        """Whether the build of the archive written to ``tmpfilename`` (see
+        `tarball_in_progress`) failed, leaving a marker in its place"""
+        return os.path.exists(tmpfilename[:-len('.tmp')] + '.failed')
+
+    def prune_tarballs(self):
+        """Remove the least recently used archives of this repository, once they
+        take more than ``scm.repos.tarball.max_size`` bytes"""
+        max_size = asint(tg.config.get('scm.repos.tarball.max_size', 0))
+        if not max_size:
+            return
+        archives = []
+        for dirname in (self.tarball_path, self.tarball_snapshot_dir):
+            if not os.path.isdir(dirname):
+                continue
+            for entry in os.scandir(dirname):
+                # links are dropped below, with their target
+                if entry.name.endswith(('.tmp', '.failed')) or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                archives.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for mtime, size, path in archives)
+        for mtime, size, path in sorted(archives):
+            if total <= max_size:
+                break
+            log.info('Removing snapshot %s', path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        if os.path.isdir(self.tarball_path):
+            for entry in os.scandir(self.tarball_path):
+                if entry.is_symlink() and not os.path.exists(entry.path):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
     def __repr__(self):  # pragma no cover
         return '<{} {}>'.format(
             self.__class__.__name__,
@@ -538,6 +609,9 @@ def set_default_branch(self, name):
     def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         return self._impl.paged_diffs(commit_id, start, end, onlyChangedFiles)
 
+    def commit_line_stats(self, commit_id):
+        return self._impl.commit_line_stats(commit_id)
+
     def init_as_clone(self, source_path, source_name, source_url):
         self.upstream_repo.name = source_name
         self.upstream_repo.url = source_url
@@ -1139,6 +1213,9 @@ def has_activity_access(self, perm, user, activity):
             return has_access(app_config, perm, user)
         return True
 
+    def activity_access_key(self, activity):
+        return ('AppConfig', activity.obj.activity_extras.get('app_config_id'))
+
     def set_context(self, repo):
         self.repo = repo
 
@@ -20,6 +20,7 @@
 from datetime import datetime
 import typing
 from tg import config
+from bson import ObjectId
 from paste.deploy.converters import asbool
 
 from ming import schema as S
@@ -31,7 +32,6 @@
 
 from allura.model.session import main_orm_session
 from allura.lib import helpers as h
-from functools import reduce
 
 if typing.TYPE_CHECKING:
     from ming.odm.mapper import Query
@@ -66,6 +66,8 @@ class __mongometa__:
             number=int,
             language=S.ObjectId)])])
 
+    # no longer read or written, last month activity is in StatsBucket.  Drop
+    # this once migration 036 has moved every document's lists to buckets
     lastmonth = FieldProperty(dict(
         messages=[dict(
             datetime=datetime,
@@ -205,131 +207,98 @@ def getTicketsByCategory(self):
         return by_cat
 
     def getLastMonthCommits(self, category=None):
-        self.checkOldArtifacts()
-        lineslist = [el.lines for el in self.lastmonth.commits
-                     if category in el.categories + [None]]
-        return dict(number=len(lineslist), lines=sum(lineslist))
+        totals = self._getLastMonthTotals([category])[category]
+        return dict(number=totals['commits'], lines=totals['lines'])
 
     def getLastMonthCommitsByCategory(self):
         from allura.model.project import TroveCategory
 
-        self.checkOldArtifacts()
         seen = set()
         catlist = [el.category for el in self.general
                    if el.category not in seen and not seen.add(el.category)]
+        totals = self._getLastMonthTotals(catlist)
 
         by_cat = {}
         for cat in catlist:
-            lineslist = [el.lines for el in self.lastmonth.commits
-                         if cat in el.categories + [None]]
-            n = len(lineslist)
-            lines = sum(lineslist)
+            n, lines = totals[cat]['commits'], totals[cat]['lines']
             if cat is not None:
                 cat = TroveCategory.query.get(_id=cat)
             by_cat[cat] = dict(number=n, lines=lines)
         return by_cat
 
+    def getLastMonthCommitsByLanguage(self, category=None):
+        from allura.model.project import TroveCategory
+
+        totals = self._getLastMonthTotals([category])[category]['languages']
+        langs = {str(lang._id): lang for lang in TroveCategory.query.find(
+            {'_id': {'$in': [ObjectId(lang) for lang in totals]}})}
+        return {langs[lang]: dict(number=t['commits'], lines=t['lines'])
+                for lang, t in totals.items() if lang in langs}
+
     def getLastMonthArtifacts(self, category=None, art_type=None):
-        self.checkOldArtifacts()
-        cre, mod = reduce(
-            addtuple,
-            [(int(el.created), 1 - int(el.created))
-                for el in self.lastmonth.messages
-                if (category is None or category in el.categories) and
-                (el.messagetype == art_type or art_type is None)],
-            (0, 0))
-        return dict(created=cre, modified=mod)
+        totals = self._getLastMonthTotals([category])[category]
+        if art_type is not None:
+            totals = totals['messages'].get(
+                art_type, dict(created=0, modified=0))
+        return dict(created=totals['created'], modified=totals['modified'])
 
     def getLastMonthArtifactsByType(self, category=None):
-        self.checkOldArtifacts()
-        seen = set()
-        types = [el.messagetype for el in self.lastmonth.messages
-                 if el.messagetype not in seen and not seen.add(el.messagetype)]
-
-        by_type = {}
-        for t in types:
-            cre, mod = reduce(
-                addtuple,
-                [(int(el.created), 1 - int(el.created))
-                 for el in self.lastmonth.messages
-                 if el.messagetype == t and
-                 category in [None] + el.categories],
-                (0, 0))
-            by_type[t] = dict(created=cre, modified=mod)
-        return by_type
+        totals = self._getLastMonthTotals([category])[category]
+        return totals['messages']
 
     def getLastMonthTickets(self, category=None):
-        from allura.model.project import TroveCategory
-
-        self.checkOldArtifacts()
-        a = len([el for el in self.lastmonth.assignedtickets
-                 if category in el.categories + [None]])
-        r = len([el for el in self.lastmonth.revokedtickets
-                 if category in el.categories + [None]])
-        s, time = reduce(
-            addtuple,
-            [(1, el.solvingtime)
-             for el in self.lastmonth.solvedtickets
-             if category in el.categories + [None]],
-            (0, 0))
-        if category is not None:
-            category = TroveCategory.query.get(_id=category)
-        if s > 0:
-            time = time / s
-        else:
-            time = None
-        return dict(
-            assigned=a,
-            revoked=r,
-            solved=s,
-            averagesolvingtime=_convertTimeDiff(time))
+        totals = self._getLastMonthTotals([category])[category]
+        return _lastMonthTickets(totals)
 
     def getLastMonthTicketsByCategory(self):
         from allura.model.project import TroveCategory
 
-        self.checkOldArtifacts()
         seen = set()
         catlist = [el.category for el in self.general
                    if el.category not in seen and not seen.add(el.category)]
+        totals = self._getLastMonthTotals(catlist)
         by_cat = {}
         for cat in catlist:
-            a = len([el for el in self.lastmonth.assignedtickets
-                     if cat in el.categories + [None]])
-            r = len([el for el in self.lastmonth.revokedtickets
-                     if cat in el.categories + [None]])
-            s, time = reduce(addtuple, [(1, el.solvingtime)
-                                        for el in self.lastmonth.solvedtickets
-                                        if cat in el.categories + [None]], (0, 0))
+            tickets = _lastMonthTickets(totals[cat])
             if cat is not None:
                 cat = TroveCategory.query.get(_id=cat)
-            if s > 0:
-                time = time / s
-            else:
-                time = None
-            by_cat[cat] = dict(
-                assigned=a,
-                revoked=r,
-                solved=s,
-                averagesolvingtime=_convertTimeDiff(time))
+            by_cat[cat] = tickets
         return by_cat
 
-    def checkOldArtifacts(self):
-        now = datetime.utcnow()
-        for m in self.lastmonth.messages:
-            if now - m.datetime > timedelta(30):
-                self.lastmonth.messages.remove(m)
-        for t in self.lastmonth.assignedtickets:
-            if now - t.datetime > timedelta(30):
-                self.lastmonth.assignedtickets.remove(t)
-        for t in self.lastmonth.revokedtickets:
-            if now - t.datetime > timedelta(30):
-                self.lastmonth.revokedtickets.remove(t)
-        for t in self.lastmonth.solvedtickets:
-            if now - t.datetime > timedelta(30):
-                self.lastmonth.solvedtickets.remove(t)
-        for c in self.lastmonth.commits:
-            if now - c.datetime > timedelta(30):
-                self.lastmonth.commits.remove(c)
+    def _getLastMonthTotals(self, categories):
+        """Sum up the last month's day buckets of each of the categories
+        (None being all of them)"""
+        totals = {cat: _emptyTotals() for cat in categories}
+        buckets = StatsBucket.query.find({
+            'stats_id': self._id,
+            'day': {'$gte': _lastMonthStart()},
+            'category': {'$in': categories},
+        }, refresh=True)
+        for b in buckets:
+            t = totals[b.category]
+            for counter in BUCKET_COUNTERS:
+                t[counter] += getattr(b, counter)
+            for mtype, counts in b.messages.items():
+                m = t['messages'].setdefault(mtype, dict(created=0, modified=0))
+                m['created'] += counts.get('created') or 0
+                m['modified'] += counts.get('modified') or 0
+            for lang, counts in b.languages.items():
+                lt = t['languages'].setdefault(lang, dict(commits=0, lines=0))
+                lt['commits'] += counts.get('commits') or 0
+                lt['lines'] += counts.get('lines') or 0
+        return totals
+
+    def _addLastMonth(self, when, topics, counters):
+        """Atomically add counters to the day buckets of the overall stats
+        and of each topic"""
+        if when < _lastMonthStart():
+            return
+        day = datetime(when.year, when.month, when.day)
+        for t in [None] + topics:
+            StatsBucket.query.update(
+                dict(stats_id=self._id, day=day, category=t),
+                {'$inc': counters},
+                upsert=True)
 
     def addNewArtifact(self, art_type, art_datetime, project):
         self._updateArtifactsStats(art_type, art_datetime, project, "created")
@@ -340,25 +309,19 @@ def addModifiedArtifact(self, art_type, art_datetime, project):
     def addAssignedTicket(self, ticket_datetime, project):
         topics = [t for t in project.trove_topic if t]
         self._updateTicketsStats(topics, 'assigned')
-        self.lastmonth.assignedtickets.append(
-            dict(datetime=ticket_datetime, categories=topics))
+        self._addLastMonth(ticket_datetime, topics, dict(assigned=1))
 
     def addRevokedTicket(self, ticket_datetime, project):
         topics = [t for t in project.trove_topic if t]
         self._updateTicketsStats(topics, 'revoked')
-        self.lastmonth.revokedtickets.append(
-            dict(datetime=ticket_datetime, categories=topics))
-        self.checkOldArtifacts()
+        self._addLastMonth(ticket_datetime, topics, dict(revoked=1))
 
     def addClosedTicket(self, open_datetime, close_datetime, project):
         topics = [t for t in project.trove_topic if t]
         s_time = int((close_datetime - open_datetime).total_seconds())
         self._updateTicketsStats(topics, 'solved', s_time=s_time)
-        self.lastmonth.solvedtickets.append(dict(
-            datetime=close_datetime,
-            categories=topics,
-            solvingtime=s_time))
-        self.checkOldArtifacts()
+        self._addLastMonth(close_datetime, topics,
+                           dict(solved=1, solvingtime=s_time))
 
     def addCommit(self, newcommit, commit_datetime, project):
         def _computeLines(newblob, oldblob=None):
@@ -416,12 +379,13 @@ def _addCommitData(stats, topics, languages, lines):
         topics = [t for t in project.trove_topic if t]
         languages = [l for l in project.trove_language if l]
 
-        d = newcommit.diffs
-        if len(newcommit.parent_ids) > 0:
-            oldcommit = newcommit.repo.commit(newcommit.parent_ids[0])
+        def _diffLines():
+            # slow fallback, for SCMs which can't count lines themselves
+            d = newcommit.diffs
+            if len(newcommit.parent_ids) > 0:
+                oldcommit = newcommit.repo.commit(newcommit.parent_ids[0])
 
-        totlines = 0
-        if asbool(config.get('userstats.count_lines_of_code', True)):
+            totlines = 0
             for changed in d.changed:
                 newblob = newcommit.tree.get_blob_by_path(changed)
                 oldblob = oldcommit.tree.get_blob_by_path(changed)
@@ -435,15 +399,24 @@ def _addCommitData(stats, topics, languages, lines):
             for added in d.added:
                 newblob = newcommit.tree.get_blob_by_path(added)
                 totlines += _computeLines(newblob)
+            return totlines
+
+        totlines = 0
+        if asbool(config.get('userstats.count_lines_of_code', True)):
+            try:
+                line_stats = newcommit.repo.commit_line_stats(newcommit._id)
+            except NotImplementedError:
+                totlines = _diffLines()
+            else:
+                totlines = sum(f['added'] for f in line_stats if f['added'])
 
         _addCommitData(self, topics, languages, totlines)
 
-        self.lastmonth.commits.append(dict(
-            datetime=commit_datetime,
-            categories=topics,
-            programming_languages=languages,
-            lines=totlines))
-        self.checkOldArtifacts()
+        counters = dict(commits=1, lines=totlines)
+        for lang in languages:
+            counters[f'languages.{lang}.commits'] = 1
+            counters[f'languages.{lang}.lines'] = totlines
+        self._addLastMonth(commit_datetime, topics, counters)
 
     def _updateArtifactsStats(self, art_type, art_datetime, project, action):
         if action not in ['created', 'modified']:
@@ -474,12 +447,10 @@ def _updateArtifactsStats(self, art_type, art_datetime, project, action):
                 else:
                     self.general[i]['messages'][j][action] += 1
 
-        self.lastmonth.messages.append(dict(
-            datetime=art_datetime,
-            created=(action == 'created'),
-            categories=topics,
-            messagetype=art_type))
-        self.checkOldArtifacts()
+        counters = {action: 1}
+        if art_type:
+            counters[f'messages.{art_type}.{action}'] = 1
+        self._addLastMonth(art_datetime, topics, counters)
 
     def _updateTicketsStats(self, topics, action, s_time=None):
         if action not in ['solved', 'assigned', 'revoked']:
@@ -504,6 +475,71 @@ def _updateTicketsStats(self, topics, action, s_time=None):
                 self.general[i]['tickets']['totsolvingtime'] += s_time
 
 
+BUCKET_COUNTERS = ('created', 'modified', 'assigned', 'revoked', 'solved',
+                   'solvingtime', 'commits', 'lines')
+
+
+class StatsBucket(MappedClass):
+    """One day of a Stats' activity, in one category (or in all of them, if
+    category is None).  Updated with $inc and summed up for the last month"""
+
+    class __mongometa__:
+        name = 'stats_bucket'
+        session = main_orm_session
+        indexes = [
+            ('stats_id', 'day'),
+            ('day',),
+        ]
+
+    query: 'Query[StatsBucket]'
+
+    _id = FieldProperty(S.ObjectId)
+    stats_id = FieldProperty(S.ObjectId)
+    day = FieldProperty(datetime)
+    category = FieldProperty(S.ObjectId, if_missing=None)
+    created = FieldProperty(int, if_missing=0)
+    modified = FieldProperty(int, if_missing=0)
+    messages = FieldProperty({str: dict(created=int, modified=int)})
+    assigned = FieldProperty(int, if_missing=0)
+    revoked = FieldProperty(int, if_missing=0)
+    solved = FieldProperty(int, if_missing=0)
+    solvingtime = FieldProperty(int, if_missing=0)
+    commits = FieldProperty(int, if_missing=0)
+    lines = FieldProperty(int, if_missing=0)
+    # commits and lines per trove programming language
+    languages = FieldProperty({str: dict(commits=int, lines=int)})
+
+    @classmethod
+    def remove_old(cls):
+        """Remove every day bucket from before the last month"""
+        cls.query.remove({'day': {'$lt': _lastMonthStart()}})
+
+
+def _lastMonthStart():
+    start = datetime.utcnow() - timedelta(30)
+    return datetime(start.year, start.month, start.day)
+
+
+def _emptyTotals():
+    totals = dict.fromkeys(BUCKET_COUNTERS, 0)
+    totals['messages'] = {}
+    totals['languages'] = {}
+    return totals
+
+
+def _lastMonthTickets(totals):
+    s = totals['solved']
+    if s > 0:
+        time = totals['solvingtime'] / s
+    else:
+        time = None
+    return dict(
+        assigned=totals['assigned'],
+        revoked=totals['revoked'],
+        solved=s,
+        averagesolvingtime=_convertTimeDiff(time))
+
+
 def getElementIndex(el_list, **kw):
     for i in range(len(el_list)):
         for k in kw:
@@ -514,12 +550,6 @@ def getElementIndex(el_list, **kw):
     return None
 
 
-def addtuple(l1, l2):
-    a, b = l1
-    x, y = l2
-    return (a + x, b + y)
-
-
 def _convertTimeDiff(int_seconds):
     if int_seconds is None:
         return None
@@ -16,25 +16,191 @@
 #       under the License.
 from __future__ import annotations
 import bson
+import datetime
 import logging
+import time
 import typing
+from collections import defaultdict
 
-from ming.odm import Mapper
-from tg import tmpl_context as c
+from ming import schema as S
+from ming.odm import FieldProperty, MappedClass, Mapper
+from paste.deploy.converters import asint
+from tg import config, tmpl_context as c, app_globals as g
 
 from activitystream import ActivityDirector
 from activitystream.base import NodeBase, ActivityObjectBase
-from activitystream.managers import Aggregator as BaseAggregator
+from activitystream.managers import (
+    ActivityManager as BaseActivityManager,
+    Aggregator as BaseAggregator,
+)
+from activitystream.storage.base import StoredActivity
+from activitystream.storage.mingstorage import Activity, activity_odm_session
 
 from allura.lib import security
 from allura.tasks.activity_tasks import create_timelines
 
 if typing.TYPE_CHECKING:
     import allura.model as M
-    from activitystream.storage.mingstorage import Activity
 
 log = logging.getLogger(__name__)
 
+# how many times the requested number of activities to check for
+# permitted ones, before leaving the rest to the next request
+MAX_TIMELINE_CHECKS = 20
+
+
+def encode_cursor(before):
+    """Serialize a (score, _id) ``before`` cursor, as returned by
+    :func:`get_permitted_timeline`, for use in urls."""
+    score, _id = before
+    return f'{score!r}:{_id}'
+
+
+def decode_cursor(token):
+    """Parse a cursor serialized by :func:`encode_cursor`.  A plain score, as
+    in older urls, continues from the activities scored lower than it.
+
+    :raises ValueError: if ``token`` isn't a cursor
+    """
+    score, sep, _id = token.partition(':')
+    try:
+        return float(score), bson.ObjectId(_id) if sep else None
+    except bson.errors.InvalidId as e:
+        raise ValueError(str(e))
+
+
+def _before_filter(before):
+    """Query for the activities after the (score, _id) ``before`` cursor in
+    timeline order.  Scores only have a resolution of one second, so the
+    _id orders the activities with the same score."""
+    score, _id = before
+    if _id is None:
+        return {'score': {'$lt': score}}
+    return {'$or': [{'score': {'$lt': score}},
+                    {'score': score, '_id': {'$lt': _id}}]}
+
+
+def timeline_cache_size():
+    """How many of the latest activities to keep in each node's
+    :class:`TimelineCache`; 0 disables the caches."""
+    return asint(config.get('activitystream.timeline_cache_size', 0))
+
+
+class TimelineCache(MappedClass):
+
+    """The ids of the latest activities on a node's timeline, oldest first,
+    added to as the activities are created so a page of the timeline can be
+    read without aggregating it first.
+
+    """
+
+    class __mongometa__:
+        session = activity_odm_session
+        name = 'timeline_cache'
+        unique_indexes = ['node_id']
+
+    _id = FieldProperty(S.ObjectId)
+    node_id = FieldProperty(str)
+    activities = FieldProperty([dict(
+        activity_id=S.ObjectId,
+        actor_id=str,
+        score=float,
+    )])
+
+    @classmethod
+    def entry(cls, activity):
+        return dict(activity_id=activity._id,
+                    actor_id=activity.actor.node_id,
+                    score=activity.score)
+
+    @classmethod
+    def fill(cls, node_id, activities, replace=False):
+        """Cache ``activities`` (newest first) as ``node_id``'s timeline.
+        Unless ``replace`` is set, a cache which already exists is kept."""
+        entries = [cls.entry(a) for a in reversed(activities)]
+        op = '$set' if replace else '$setOnInsert'
+        cls.query.update({'node_id': node_id},
+                         {op: {'activities': entries}},
+                         upsert=True)
+
+    @classmethod
+    def push(cls, node_ids, activity, size):
+        """Add ``activity`` to the existing caches of ``node_ids``, keeping
+        the latest ``size`` activities in each."""
+        if not node_ids:
+            return
+        cls.query.update(
+            {'node_id': {'$in': list(node_ids)}},
+            {'$push': {'activities': {'$each': [cls.entry(activity)],
+                                      '$slice': -size}}},
+            multi=True)
+
+    @classmethod
+    def remove_activities(cls, activity_ids):
+        cls.query.update(
+            {'activities.activity_id': {'$in': activity_ids}},
+            {'$pull': {'activities': {'activity_id': {'$in': activity_ids}}}},
+            multi=True)
+
+    def get_page(self, page, limit, size, actor_only=False, before=None):
+        """Return a page of the cached timeline, or None if it goes past the
+        activities kept in the cache."""
+        # a cache holding fewer than ``size`` activities holds all of them
+        complete = len(self.activities) < size
+        # same order as the aggregated timeline, newest first
+        entries = sorted(self.activities, key=lambda e: (e.score, e.activity_id), reverse=True)
+        if actor_only:
+            entries = [e for e in entries if e.actor_id == self.node_id]
+        if before is not None:
+            score, _id = before
+            if _id is None:
+                entries = [e for e in entries if e.score < score]
+            else:
+                entries = [e for e in entries if (e.score, e.activity_id) < (score, _id)]
+            start = 0
+        else:
+            start = page * limit
+        if not limit:
+            if not complete:
+                return None
+            limit = len(entries)
+        ids = [e.activity_id for e in entries[start:start + limit]]
+        if len(ids) < limit and not complete:
+            return None
+        if not ids:
+            return []
+        activities = {a._id: a for a in Activity.query.find({'_id': {'$in': ids}})}
+        return [activities[_id] for _id in ids if _id in activities]
+
+
+class ActivityManager(BaseActivityManager):
+
+    """Scores the activities as they are created, and returns the stored
+    :class:`Activity` so it can be added to the timeline caches.
+
+    """
+
+    def create(self, actor, verb, obj, target=None, related_nodes=None, tags=None):
+        related_nodes = related_nodes or []
+        owners = [
+            node.node_id for node in [actor, obj, target] + related_nodes
+            if getattr(node, 'node_id', None)]
+        published = datetime.datetime.utcnow()
+        score = time.mktime(published.timetuple())
+        activity = None
+        for owner in owners:
+            activity = self.storage.save_activity(StoredActivity(
+                actor=actor,
+                verb=verb,
+                obj=obj,
+                target=target,
+                published=published,
+                score=score,
+                node_id=owner,
+                tags=tags,
+            ))
+        return activity
+
 
 class Director(ActivityDirector):
 
@@ -49,10 +215,11 @@ def create_activity(self, actor, verb, obj, target=None,
             return
 
         from allura.model.project import Project
-        super().create_activity(actor, verb, obj,
-                                target=target,
-                                related_nodes=related_nodes,
-                                tags=tags)
+        activity = super().create_activity(actor, verb, obj,
+                                           target=target,
+                                           related_nodes=related_nodes,
+                                           tags=tags)
+        self.add_to_timeline_caches(activity, [actor, obj, target] + (related_nodes or []))
         # aggregate actor and follower's timelines
         if actor.node_id:
             create_timelines.post(actor.node_id)
@@ -61,6 +228,83 @@ def create_activity(self, actor, verb, obj, target=None,
             if isinstance(node, Project):
                 create_timelines.post(node.node_id)
 
+    def connect(self, follower, following):
+        super().connect(follower, following)
+        # the follower's cached timeline lacks the followed node's activities
+        TimelineCache.query.remove({'node_id': follower.node_id})
+
+    def disconnect(self, follower, following):
+        super().disconnect(follower, following)
+        TimelineCache.query.remove({'node_id': follower.node_id})
+
+    def get_timeline(self, node, page=0, limit=100, actor_only=False,
+                     filter_func=None, before=None):
+        """Return a (paged and limited) timeline for `node`.
+
+        If `before`, a (score, _id) cursor, is given, the timeline continues
+        after that activity instead of skipping to `page`.
+
+        With ``activitystream.timeline_cache_size`` set, the page is read
+        from the node's :class:`TimelineCache` when it holds it, and the
+        cache is started on the first read.
+        """
+        node_id = node.node_id
+        cache_size = timeline_cache_size()
+        cache = None
+        timeline = None
+        if cache_size:
+            cache = TimelineCache.query.get(node_id=node_id)
+            if cache:
+                timeline = cache.get_page(page, limit, cache_size,
+                                          actor_only=actor_only, before=before)
+        if timeline is None:
+            timeline = self._get_aggregated_timeline(node, page, limit,
+                                                     actor_only, before)
+            if cache_size and cache is None:
+                self.fill_timeline_cache(node_id)
+        if filter_func:
+            timeline = list(filter(filter_func, timeline))
+        return timeline
+
+    def _get_aggregated_timeline(self, node, page, limit, actor_only, before):
+        node_id = node.node_id
+        node = self.node_manager.get_node(node_id)
+        if not node or self.aggregator.needs_aggregation(node):
+            self.create_timeline(node_id)
+        page, limit = int(page), int(limit or 0)
+        query_filter = {}
+        skip = page * limit
+        if before is not None:
+            query_filter = _before_filter(before)
+            skip = 0
+        if actor_only:
+            query_filter['actor.node_id'] = node_id
+        return self.activity_manager.get_timeline(
+            node_id, sort=[('score', -1), ('_id', -1)], skip=skip, limit=limit,
+            query=query_filter)
+
+    def fill_timeline_cache(self, node_id, replace=False):
+        """Cache the latest activities of ``node_id``'s aggregated timeline.
+        Unless ``replace`` is set, a cache which already exists is kept."""
+        cache_size = timeline_cache_size()
+        if not cache_size:
+            return
+        timeline = self.activity_manager.get_timeline(
+            node_id, sort=[('score', -1), ('_id', -1)], limit=cache_size)
+        TimelineCache.fill(node_id, timeline, replace=replace)
+
+    def add_to_timeline_caches(self, activity, nodes):
+        """Add a new ``activity`` to the timeline caches of ``nodes`` and
+        their followers."""
+        cache_size = timeline_cache_size()
+        # only the stored activities returned by our ActivityManager can be cached
+        if not cache_size or getattr(activity, '_id', None) is None:
+            return
+        node_ids = {node.node_id for node in nodes if getattr(node, 'node_id', None)}
+        for node in self.node_manager.get_nodes(list(node_ids)):
+            node_ids.update(node.followers or [])
+        TimelineCache.push(node_ids, activity, cache_size)
+
 
 class Aggregator(BaseAggregator):
     pass
@@ -109,6 +353,17 @@ def has_activity_access(self, perm, user, activity):
             return False
         return security.has_access(self, perm, user, self.project)
 
+    def activity_access_key(self, activity):
+        """Return a key which other objects share only if their
+        has_activity_access() is sure to be the same as this one's, so the
+        result can be reused within a timeline.  Return None if it can't be.
+
+        Subclasses overriding has_activity_access() must override this too.
+        """
+        if self.project is None or getattr(self, 'deleted', False):
+            return None
+        return security_context_key(self)
+
 
 class TransientActor(NodeBase, ActivityObjectBase):
     """An activity actor which is not a persistent Node in the network.
@@ -130,6 +385,18 @@ def get_allura_id(activity_object_dict):
     return allura_id
 
 
+def security_context_key(obj):
+    """Identify the parent security context of an object without an ACL of
+    its own: such an object's access is the same as its parent's.
+    """
+    if getattr(obj, 'acl', True):
+        return None
+    parent = obj.parent_security_context()
+    if parent is None:
+        return None
+    return (parent.__class__.__name__, parent._id)
+
+
 def get_activity_object(activity_object_dict):
     """Given a BSON-serialized activity object (e.g. activity.obj dict in a
     timeline), return the corresponding :class:`ActivityObject`.
@@ -148,19 +415,95 @@ def get_activity_object(activity_object_dict):
     return obj
 
 
-def perm_check(user: M.User):
+def get_activity_objects(activity_object_dicts):
+    """Like :func:`get_activity_object` for many activity objects, with one
+    query per class.  Returns a dict of allura ids to the objects found.
+
+    """
+    ids_by_class = defaultdict(dict)
+    for activity_object_dict in activity_object_dicts:
+        allura_id = get_allura_id(activity_object_dict)
+        if not allura_id:
+            continue
+        classname, _id = allura_id.split(':', 1)
+        try:
+            _id = bson.ObjectId(_id)
+        except bson.errors.InvalidId:
+            pass
+        ids_by_class[classname][_id] = allura_id
+    objects = {}
+    for classname, ids in ids_by_class.items():
+        cls = Mapper.by_classname(classname).mapped_class
+        for obj in cls.query.find({'_id': {'$in': list(ids)}}):
+            objects[ids[obj._id]] = obj
+    return objects
+
+
+def perm_check(user: M.User, objects: dict | None = None):
     """
     Return a function that returns True if ``user`` has 'read' access to a given activity,
     otherwise returns False.
+
+    ``objects`` may hold the activities' objects by allura id, as loaded by
+    :func:`get_activity_objects`.  Results are reused for objects with the
+    same :meth:`ActivityObject.activity_access_key`.
     """
+    access = {}
+
     def _perm_check(activity: Activity):
-        if not get_allura_id(activity.obj):
+        allura_id = get_allura_id(activity.obj)
+        if not allura_id:
             # include activity records that do not have an allura object
             return True
-        obj = get_activity_object(activity.obj)
+        if objects is not None:
+            obj = objects.get(allura_id)
+        else:
+            obj = get_activity_object(activity.obj)
         if obj is None:
             # Do not include if there's supposed to be an allura object, but it's missing
             return False
         # Finally, if there's an allura object, perform a permission check
-        return obj.has_activity_access('read', user, activity)
+        key = obj.activity_access_key(activity)
+        if key is None:
+            return bool(obj.has_activity_access('read', user, activity))
+        if key not in access:
+            access[key] = bool(obj.has_activity_access('read', user, activity))
+        return access[key]
     return _perm_check
+
+
+def get_permitted_timeline(node, user, limit, page=0, before=None, actor_only=False):
+    """
+    Return up to ``limit`` activities from ``node``'s timeline which ``user``
+    may read, the (score, _id) cursor to continue the timeline from, and
+    whether there may be more.
+
+    The timeline is read ``limit`` activities at a time, continuing after the
+    last activity checked, until enough are permitted or MAX_TIMELINE_CHECKS
+    times ``limit`` have been checked.  Requests for a ``page`` past the first
+    only check that page, so pages don't overlap.
+    """
+    objects = {}
+    check = perm_check(user, objects)
+    timeline = []
+    fill = before is not None or page == 0
+    checked_total = 0
+    while True:
+        batch = g.director.get_timeline(node, page, limit=limit,
+                                        actor_only=actor_only, before=before)
+        objects.update(get_activity_objects([a.obj for a in batch]))
+        checked = 0
+        for activity in batch:
+            if len(timeline) == limit:
+                break
+            checked += 1
+            if check(activity):
+                timeline.append(activity)
+        checked_total += checked
+        has_more = checked < len(batch) or len(batch) == limit
+        if checked:
+            before = (batch[checked - 1].score, batch[checked - 1]._id)
+        if (not has_more or not fill or before is None or len(timeline) == limit or
+                checked_total >= limit * MAX_TIMELINE_CHECKS):
+            break
+    return timeline, before if has_more else None, has_more
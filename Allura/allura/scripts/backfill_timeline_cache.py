@@ -0,0 +1,64 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import argparse
+import logging
+
+from tg import app_globals as g
+from activitystream.storage.mingstorage import Node, activity_odm_session
+
+from allura.lib.utils import chunked_find
+from allura.model.timeline import timeline_cache_size
+from allura.scripts import ScriptTask
+
+log = logging.getLogger(__name__)
+
+
+class BackfillTimelineCache(ScriptTask):
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description="Fill the timeline caches of users and projects from their "
+                                                     "aggregated timelines.  Needed if "
+                                                     "activitystream.timeline_cache_size is enabled")
+        parser.add_argument('--replace', action='store_true', dest='replace',
+                            help='Replace timeline caches which already exist')
+        return parser
+
+    @classmethod
+    def execute(cls, options):
+        if not timeline_cache_size():
+            log.error('activitystream.timeline_cache_size is not set, nothing to do')
+            return
+        for i, chunk in enumerate(chunked_find(Node, {})):
+            log.info('Backfilling timeline caches for chunk #%s', i)
+            for node in chunk:
+                try:
+                    g.director.create_timeline(node.node_id)
+                    g.director.fill_timeline_cache(node.node_id, replace=options.replace)
+                except Exception:
+                    log.exception('Error backfilling timeline cache for %s', node.node_id)
+            activity_odm_session.clear()
+        log.info('Finished backfilling timeline caches')
+
+
+def get_parser():
+    return BackfillTimelineCache.parser()
+
+
+if __name__ == '__main__':
+    BackfillTimelineCache.main()
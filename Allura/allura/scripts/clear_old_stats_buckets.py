@@ -0,0 +1,44 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import logging
+
+import argparse
+
+from allura.scripts import ScriptTask
+from allura.model.stats import StatsBucket
+
+log = logging.getLogger('allura.scripts.clear_old_stats_buckets')
+
+
+class ClearOldStatsBuckets(ScriptTask):
+
+    @classmethod
+    def parser(cls):
+        return argparse.ArgumentParser(description="Remove user stats day buckets from before the last month")
+
+    @classmethod
+    def execute(cls, options):
+        StatsBucket.remove_old()
+
+
+def get_parser():
+    return ClearOldStatsBuckets.parser()
+
+
+if __name__ == '__main__':
+    ClearOldStatsBuckets.main()
@@ -18,25 +18,35 @@
 """
 Generate Allura sitemap xml files.  You will need to configure your webserver to serve the files.
 
-This takes a while to run on a prod-sized data set. There are a couple of
-things that would make it faster, if we need/want to.
+This takes a while to run on a prod-sized data set. With --processes, projects
+are split into shards of --shard-size projects by _id range, and each shard is
+streamed into gzipped sitemap files by a pool of processes.  Sharded runs keep
+a manifest of the shards, so --incremental can later regenerate only the
+shards with updated, added or removed projects.
 
-1. Monkeypatch forgetracker.model.ticket.Globals.bin_count to skip the
-   refresh (Solr search) and just return zero for everything, since we don't
-   need bin counts for the sitemap.
-
-2. Use multiprocessing to distribute the offsets to n subprocesses.
+It could be faster still by monkeypatching
+forgetracker.model.ticket.Globals.bin_count to skip the refresh (Solr search)
+and just return zero for everything, since we don't need bin counts for the
+sitemap.
 """
 
 import os
+import bisect
+import gzip
+import json
+import multiprocessing
 from datetime import datetime
+from xml.sax.saxutils import escape
 import argparse
 
+from bson import ObjectId
+
 from jinja2 import Template
 import tg
 import webob
 from tg import tmpl_context as c
-from ming.odm import ThreadLocalODMSession
+from ming import Session
+from ming.odm import ThreadLocalODMSession, session
 from tg import config
 
 from allura import model as M
@@ -45,6 +55,7 @@
 
 
 MAX_SITEMAP_URLS = 50000
+MANIFEST_FILE = 'sitemap-shards.json'
 
 INDEX_TEMPLATE = """\
 <?xml version="1.0" encoding="utf-8"?>
@@ -71,6 +82,23 @@
 </urlset>
 """
 
+SITEMAP_HEADER = """\
+<?xml version="1.0" encoding="utf-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+"""
+
+SITEMAP_URL = """\
+    <url>
+        <loc>%s</loc>
+        <lastmod>%s</lastmod>
+        <changefreq>daily</changefreq>
+    </url>
+"""
+
+SITEMAP_FOOTER = """\
+</urlset>
+"""
+
 
 class CreateSitemapFiles(ScriptTask):
 
@@ -85,9 +113,23 @@ def execute(cls, options):
         tg.request_local.context.request = webob.Request.blank('/')
 
         output_path = options.output_dir
-        if os.path.exists(output_path):
+        if options.incremental:
+            if not os.path.exists(os.path.join(output_path, MANIFEST_FILE)):
+                raise Exception('%s has no sitemap shards to update.' % output_path)
+        elif os.path.exists(output_path):
             raise Exception('%s directory already exists.' % output_path)
-        os.mkdir(output_path)
+        else:
+            os.mkdir(output_path)
+
+        excl_nbhd_ids = []
+        if options.exclude_neighborhoods:
+            prefix = ['/%s/' % n for n in options.exclude_neighborhoods]
+            excl_nbhd_ids = [nbhd._id for nbhd in M.Neighborhood.query.find({'url_prefix': {'$in': prefix}})]
+        query = {'deleted': False, 'neighborhood_id': {'$nin': excl_nbhd_ids}}
+
+        if options.processes or options.incremental:
+            cls.write_shards(options, query)
+            return
 
         now = datetime.utcnow().date()
         sitemap_content_template = Template(SITEMAP_TEMPLATE)
@@ -97,29 +139,13 @@ def write_sitemap(urls, file_no):
             with open(os.path.join(output_path, 'sitemap-%d.xml' % file_no), 'w') as f:
                 f.write(sitemap_content)
 
-        creds = security.Credentials.get()
         locs = []
         file_count = 0
 
-        excl_nbhd_ids = []
-        if options.exclude_neighborhoods:
-            prefix = ['/%s/' % n for n in options.exclude_neighborhoods]
-            excl_nbhd_ids = [nbhd._id for nbhd in M.Neighborhood.query.find({'url_prefix': {'$in': prefix}})]
-
         # write sitemap files, MAX_SITEMAP_URLS per file
-        for chunk in utils.chunked_find(M.Project, {'deleted': False, 'neighborhood_id': {'$nin': excl_nbhd_ids}}):
+        for chunk in utils.chunked_find(M.Project, query):
             for p in chunk:
-                c.project = p
-                try:
-                    for s in p.sitemap(excluded_tools=options.exclude_tools, xml=True):
-                        url = config['base_url'] + s.url if s.url[0] == '/' else s.url
-                        locs.append({'url': url,
-                                     'date': p.last_updated.strftime("%Y-%m-%d")})
-
-                except Exception as e:
-                    print("Error creating sitemap for project '%s': %s" %\
-                        (p.shortname, e))
-                creds.clear()
+                locs.extend(cls.project_locs(p, options))
                 if len(locs) >= options.urls_per_file:
                     write_sitemap(locs[:options.urls_per_file], file_count)
                     del locs[:options.urls_per_file]
@@ -132,15 +158,120 @@ def write_sitemap(urls, file_no):
             file_count += 1
         # write sitemap index file
         if file_count:
-            sitemap_index_vars = dict(
-                now=now,
-                sitemaps=[
-                    '%s%s/sitemap-%d.xml' % (config['base_url'], options.url_dir, n)
-                    for n in range(file_count)])
-            sitemap_index_content = Template(
-                INDEX_TEMPLATE).render(sitemap_index_vars)
-            with open(os.path.join(output_path, 'sitemap.xml'), 'w') as f:
-                f.write(sitemap_index_content)
+            cls.write_index(options, ['sitemap-%d.xml' % n for n in range(file_count)])
+
+    @classmethod
+    def project_locs(cls, p, options):
+        c.project = p
+        locs = []
+        try:
+            for s in p.sitemap(excluded_tools=options.exclude_tools, xml=True):
+                url = config['base_url'] + s.url if s.url[0] == '/' else s.url
+                locs.append({'url': url,
+                             'date': p.last_updated.strftime("%Y-%m-%d")})
+        except Exception as e:
+            print("Error creating sitemap for project '%s': %s" %\
+                (p.shortname, e))
+        security.Credentials.get().clear()
+        return locs
+
+    @classmethod
+    def write_index(cls, options, filenames):
+        sitemap_index_vars = dict(
+            now=datetime.utcnow().date(),
+            sitemaps=[
+                '%s%s/%s' % (config['base_url'], options.url_dir, filename)
+                for filename in filenames])
+        sitemap_index_content = Template(
+            INDEX_TEMPLATE).render(sitemap_index_vars)
+        with open(os.path.join(options.output_dir, 'sitemap.xml'), 'w') as f:
+            f.write(sitemap_index_content)
+
+    @classmethod
+    def write_shards(cls, options, query):
+        manifest_path = os.path.join(options.output_dir, MANIFEST_FILE)
+        generated = datetime.utcnow()
+        old_shards = {}
+        split_from = None
+        if options.incremental:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            old_shards = {(s['start'], s['end']): s for s in manifest['shards']}
+            # keep the old _id ranges, so only their changes need regenerating.
+            # New projects go at the end, so just the last shard is re-split
+            split_from = manifest['shards'][-1]['start'] if manifest['shards'] else None
+            shards = [dict(s) for s in manifest['shards'][:-1]]
+            shards += shard_ranges(query, options.shard_size, split_from)
+            cls.count_projects(shards, query)
+            updated = cls.updated_shards(
+                shards, query, datetime.strptime(manifest['generated'], '%Y-%m-%dT%H:%M:%S.%f'))
+        else:
+            shards = shard_ranges(query, options.shard_size)
+            updated = set(range(len(shards)))
+
+        todo = []
+        for i, s in enumerate(shards):
+            old = old_shards.pop((s['start'], s['end']), None)
+            if old and i not in updated and old['projects'] == s['projects']:
+                s['files'] = old['files']
+            else:
+                if old:
+                    remove_files(options.output_dir, old['files'])
+                todo.append(i)
+        for old in old_shards.values():
+            remove_files(options.output_dir, old['files'])
+
+        args = [(options, query, shards[i]) for i in todo]
+        if options.processes > 1 and len(todo) > 1:
+            # forked children must open their own database connections
+            pool = multiprocessing.get_context('fork').Pool(
+                options.processes, initializer=_reset_connections)
+            with pool:
+                results = pool.map(_write_shard, args)
+        else:
+            results = [_write_shard(a) for a in args]
+        for i, files in zip(todo, results):
+            shards[i]['files'] = files
+
+        with open(manifest_path, 'w') as f:
+            json.dump(dict(generated=generated.isoformat(timespec='microseconds'),
+                           shards=shards), f)
+        cls.write_index(options, [fn for s in shards for fn in s['files']])
+
+    @classmethod
+    def count_projects(cls, shards, query):
+        starts = [s['start'] for s in shards[1:]]
+        for s in shards:
+            s['projects'] = 0
+        for _id in _projects(query):
+            shards[bisect.bisect_right(starts, str(_id))]['projects'] += 1
+
+    @classmethod
+    def updated_shards(cls, shards, query, since):
+        starts = [s['start'] for s in shards[1:]]
+        query = dict(query, last_updated={'$gte': since})
+        return {bisect.bisect_right(starts, str(_id)) for _id in _projects(query)}
+
+    @classmethod
+    def write_shard(cls, options, query, shard):
+        """Stream the sitemap of a shard of projects into gzipped files"""
+        query = dict(query)
+        if shard['start'] or shard['end']:
+            query['_id'] = {}
+            if shard['start']:
+                query['_id']['$gte'] = ObjectId(shard['start'])
+            if shard['end']:
+                query['_id']['$lt'] = ObjectId(shard['end'])
+        writer = SitemapWriter(options.output_dir, 'sitemap-%s' % (shard['start'] or 0),
+                               options.urls_per_file)
+        with writer:
+            for chunk in utils.chunked_find(M.Project, query):
+                for p in chunk:
+                    for loc in cls.project_locs(p, options):
+                        writer.add(loc)
+                    M.main_orm_session.clear()
+                ThreadLocalODMSession.close_all()
+        return writer.files
 
     @classmethod
     def parser(cls):
@@ -171,9 +302,94 @@ def __call__(self, parser, namespace, value, option_string=None):
         parser.add_argument('--url-dir', dest='url_dir',
                             default='/allura_sitemap',
                             help='URL directory in which the files will be served from')
+        parser.add_argument('--processes', dest='processes', default=0, type=int,
+                            help='Write gzipped sitemap files for shards of projects, using this many '
+                            'processes.  [default: %(default)s, writes plain files serially]')
+        parser.add_argument('--shard-size', dest='shard_size', default=1000, type=int,
+                            help='Number of projects per shard. [default: %(default)s]')
+        parser.add_argument('--incremental', dest='incremental', action='store_true',
+                            help='Only regenerate shards with changed projects, in an existing '
+                            'output directory written with --processes')
         return parser
 
 
+class SitemapWriter:
+    """Writes sitemap urls to gzipped files as they come, urls_per_file at most in each"""
+
+    def __init__(self, output_dir, prefix, urls_per_file):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.urls_per_file = urls_per_file
+        self.files = []
+        self.f = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, loc):
+        if self.f is None or self.count >= self.urls_per_file:
+            self.close()
+            filename = '%s-%d.xml.gz' % (self.prefix, len(self.files))
+            self.f = gzip.open(os.path.join(self.output_dir, filename), 'wt', encoding='utf-8')
+            self.f.write(SITEMAP_HEADER)
+            self.files.append(filename)
+            self.count = 0
+        self.f.write(SITEMAP_URL % (escape(loc['url']), loc['date']))
+        self.count += 1
+
+    def close(self):
+        if self.f is not None:
+            self.f.write(SITEMAP_FOOTER)
+            self.f.close()
+            self.f = None
+
+
+def shard_ranges(query, shard_size, start=None):
+    """Split the projects into _id ranges of shard_size projects.  Ranges are
+    stored as strings, and the first and last ones are open ended"""
+    if start:
+        query = dict(query, _id={'$gte': ObjectId(start)})
+    shards = []
+    for i, _id in enumerate(_projects(query)):
+        if i % shard_size == 0:
+            if shards:
+                shards[-1]['end'] = str(_id)
+            shards.append(dict(start=str(_id) if shards else start, end=None, projects=0))
+        shards[-1]['projects'] += 1
+    if not shards:
+        shards.append(dict(start=start, end=None, projects=0))
+    return shards
+
+
+def remove_files(output_dir, filenames):
+    for filename in filenames:
+        path = os.path.join(output_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _projects(query):
+    """The _ids of the projects matching query, in order"""
+    for p in M.Project.query.find(query, projection={'_id': 1}).sort('_id'):
+        # don't leave half loaded projects in the session for later queries
+        session(p).expunge(p)
+        yield p._id
+
+
+def _write_shard(args):
+    return CreateSitemapFiles.write_shard(*args)
+
+
+def _reset_connections():
+    # connect again, rather than sharing the parent process' sockets
+    for datastore in Session._datastores.values():
+        datastore.bind._conn = None
+
+
 def get_parser():
     return CreateSitemapFiles.parser()
 
@@ -19,54 +19,124 @@
 import os.path
 import logging
 import shutil
+import zipfile
+from datetime import datetime
 
 import tg
+from paste.deploy.converters import asint
 from tg import app_globals as g, tmpl_context as c
 
 from allura.tasks import mail_tasks
 from allura.lib.decorators import task
 from allura.lib import helpers as h
-from allura.model.repository import zipdir
 
 
 log = logging.getLogger(__name__)
 
 
 @task
-def bulk_export(tools, filename=None, send_email=True, with_attachments=False):
+def bulk_export(tools, filename=None, send_email=True, with_attachments=False, incremental=False):
     '''
     Export the current project data.  Send notification to current user.
 
     :param list tools: list of mount_points to export
     :param str filename: optional filename to use
+    :param bool incremental: only export what changed since the last incremental export
     '''
     # it's very handy to use c.* within a @task,
     # but let's be explicit and keep it separate from the main code
-    return BulkExport().process(c.project, tools, c.user, filename, send_email, with_attachments)
+    return BulkExport().process(c.project, tools, c.user, filename, send_email, with_attachments, incremental)
+
+
+@task
+def bulk_export_tool(tool, filename, send_email=True, with_attachments=False, incremental=False):
+    '''
+    Export a single tool, as part of a :func:`bulk_export` which is exporting
+    several tools in parallel.
+
+    :param str tool: mount_point to export
+    :param str filename: filename of the whole export
+    '''
+    return BulkExport().process_tool(c.project, tool, c.user, filename, send_email, with_attachments, incremental)
 
 
 class BulkExport:
 
-    def process(self, project, tools, user, filename=None, send_email=True, with_attachments=False):
+    def process(self, project, tools, user, filename=None, send_email=True, with_attachments=False,
+                incremental=False):
         export_filename = filename or project.bulk_export_filename()
-        tmp_path = os.path.join(
-            project.bulk_export_path(rootdir=tg.config.get('bulk_export_tmpdir', tg.config['bulk_export_path'])),
-            os.path.splitext(export_filename)[0],  # e.g. test-backup-2018-06-26-210524 without the .zip
-        )
-        export_path = project.bulk_export_path(rootdir=tg.config['bulk_export_path'])
-        export_fullpath = os.path.join(export_path, export_filename)
+        tmp_path = self.tmp_path(project, export_filename)
         if not os.path.exists(tmp_path):
             os.makedirs(tmp_path)
-        if not os.path.exists(export_path):
-            os.makedirs(export_path)
         apps = [project.app_instance(tool) for tool in tools]
         exportable = self.filter_exportable(apps)
-        results = [self.export(tmp_path, app, with_attachments) for app in exportable]
-        exported = self.filter_successful(results)
-        if exported:
-            zipdir(tmp_path, export_fullpath)
-        shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
+        exportable_tools = [app.config.options.mount_point for app in exportable]
+        project.clear_bulk_export_progress()
+        progress = {}
+        for tool in tools:
+            progress = project.set_bulk_export_progress(tool, 'queued' if tool in exportable_tools else 'skipped')
+
+        concurrency = asint(tg.config.get('bulk_export_concurrency', 1))
+        if concurrency > 1 and len(exportable_tools) > 1:
+            # each tool gets its own task, so the taskd workers are the process pool.
+            # Only ``concurrency`` are started here, each one starts the next queued
+            # tool when it's done and the last one builds the zip
+            for tool in exportable_tools[:concurrency]:
+                project.set_bulk_export_progress(tool, 'busy')
+                bulk_export_tool.post(tool, export_filename, send_email, with_attachments, incremental)
+            return
 
+        zf = None
+        try:
+            for app in exportable:
+                tool = app.config.options.mount_point
+                project.set_bulk_export_progress(tool, 'busy')
+                if self.export(tmp_path, app, with_attachments, incremental) is None:
+                    progress = project.set_bulk_export_progress(tool, 'failed')
+                    continue
+                if zf is None:
+                    zf = self.open_zip(project, export_filename)
+                # move each tool's files into the zip as soon as it's done, so
+                # only one tool's export is ever on disk uncompressed
+                self.add_to_zip(zf, tmp_path)
+                progress = project.set_bulk_export_progress(tool, 'done')
+        finally:
+            if zf is not None:
+                zf.close()
+            shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
+
+        project.clear_bulk_export_progress()
+        self.notify(project, progress, user, export_filename, send_email)
+
+    def process_tool(self, project, tool, user, filename, send_email=True, with_attachments=False,
+                     incremental=False):
+        tmp_path = self.tmp_path(project, filename)
+        app = project.app_instance(tool)
+        exported = app is not None and self.export(tmp_path, app, with_attachments, incremental) is not None
+        progress = project.set_bulk_export_progress(tool, 'done' if exported else 'failed')
+
+        for next_tool, status in progress.items():
+            # another task may claim the same tool first, then try the next one
+            if status == 'queued' and project.set_bulk_export_progress(next_tool, 'busy', expect='queued'):
+                bulk_export_tool.post(next_tool, filename, send_email, with_attachments, incremental)
+                return
+        if 'busy' in progress.values() or 'queued' in progress.values():
+            return  # a task which is still running will finish the export
+        if not project.clear_bulk_export_progress():
+            return  # another task finishing at the same time got here first
+
+        zf = None
+        try:
+            if 'done' in progress.values():
+                zf = self.open_zip(project, filename)
+                self.add_to_zip(zf, tmp_path)
+        finally:
+            if zf is not None:
+                zf.close()
+            shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
+        self.notify(project, progress, user, filename, send_email)
+
+    def notify(self, project, progress, user, filename, send_email=True):
         if not user:
             log.info('No user. Skipping notification.')
             return
@@ -77,30 +147,58 @@ def process(self, project, tools, user, filename=None, send_email=True, with_att
         instructions = tg.config.get('bulk_export_download_instructions', '')
         instructions = instructions.format(
             project=project.shortname,
-            filename=export_filename,
+            filename=filename,
             c=c,
         )
-        exported_names = [a.config.options.mount_point for a in exported]
         tmpl_context = {
             'instructions': instructions,
             'project': project,
-            'tools': exported_names,
-            'not_exported_tools': list(set(tools) - set(exported_names)),
+            'tools': [tool for tool, status in progress.items() if status == 'done'],
+            'not_exported_tools': [tool for tool, status in progress.items() if status != 'done'],
         }
 
         mail_tasks.send_system_mail_to_user(user,
                                             'Bulk export for project %s completed' % project.shortname,
                                             tmpl.render(tmpl_context))
 
+    def tmp_path(self, project, filename):
+        return os.path.join(
+            project.bulk_export_path(rootdir=tg.config.get('bulk_export_tmpdir', tg.config['bulk_export_path'])),
+            os.path.splitext(filename)[0],  # e.g. test-backup-2018-06-26-210524 without the .zip
+        )
+
+    def open_zip(self, project, filename):
+        export_path = project.bulk_export_path(rootdir=tg.config['bulk_export_path'])
+        if not os.path.exists(export_path):
+            os.makedirs(export_path)
+        return zipfile.ZipFile(os.path.join(export_path, filename), 'w', zipfile.ZIP_DEFLATED)
+
+    def add_to_zip(self, zf, path):
+        """Move the files under ``path`` into the open zip file ``zf``, under
+        a top-level directory named after ``path``."""
+        prefix = os.path.dirname(path.rstrip('/'))
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                zf.write(full_path, os.path.relpath(full_path, prefix))
+                os.remove(full_path)
+
     def filter_exportable(self, apps):
         return [app for app in apps if app and app.exportable]
 
-    def export(self, export_path, app, with_attachments=False):
+    def export(self, export_path, app, with_attachments=False, incremental=False):
         tool = app.config.options.mount_point
         json_file = os.path.join(export_path, '%s.json' % tool)
+        kw = {}
+        if incremental and app.incremental_export:
+            # no mark yet means a full export, which the next one builds on
+            kw['since'] = app.config.bulk_export_mark
+        started = datetime.utcnow()
+        # mongo keeps only milliseconds, round down so nothing saved meanwhile is missed
+        started = started.replace(microsecond=started.microsecond // 1000 * 1000)
         try:
             with open(json_file, 'w', encoding='utf-8') as f:
-                app.bulk_export(f, export_path, with_attachments)
+                app.bulk_export(f, export_path, with_attachments, **kw)
         except Exception:
             log.error('Error exporting: %s on %s', tool,
                       app.project.shortname, exc_info=True)
@@ -110,6 +208,9 @@ def export(self, export_path, app, with_attachments=False):
                 pass
             return None
         else:
+            if incremental:
+                # anything changed while exporting is caught by the next export
+                app.config.bulk_export_mark = started
             return app
 
     def filter_successful(self, results):
@@ -21,6 +21,7 @@
 from tg import tmpl_context as c, app_globals as g, config
 from bson import ObjectId
 import markupsafe
+from paste.deploy.converters import asint, aslist
 
 from allura.lib import helpers as h
 from allura.lib.decorators import task
@@ -138,19 +139,36 @@ def replace_html(matchobj):
     return multi_msg, plain_msg
 
 
+def _retry_delay(attempt):
+    """Seconds to wait before delivery attempt number ``attempt + 1``, or None
+    if no more retries should be made"""
+    delays = [int(d) for d in aslist(config.get('forgemail.retry', [60, 300, 900]))]
+    if attempt < len(delays):
+        return delays[attempt]
+    return None
+
+
 @task
 def sendmail(fromaddr, destinations, text, reply_to, subject,
-             message_id, in_reply_to=None, sender=None, references=None, metalink=None):
+             message_id, in_reply_to=None, sender=None, references=None, metalink=None, attempt=0):
     '''
     Send an email to the specified list of destinations with respect to the preferred email format specified by user.
     It is best for broadcast messages.
 
+    Recipients share envelopes of up to ``forgemail.max_envelope_recipients`` addresses.  If the SMTP server
+    fails transiently, the undelivered destinations are retried later by reposting this task with a delay.
+
     :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
+    :param attempt: number of previous delivery attempts, used for retries
 
     '''
     from allura import model as M
     addrs_plain = []
     addrs_multi = []
+    # email address as given to SMTPClient -> original destination, for retries
+    sources = {}
+    # the user id or address given, as fromaddr is replaced by a Header which can't be saved in a retry
+    orig_fromaddr = fromaddr
     if fromaddr is None:
         fromaddr = g.noreply
     elif not isinstance(fromaddr, str) or '@' not in fromaddr:
@@ -161,42 +179,68 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
             fromaddr = g.noreply
         else:
             fromaddr = user.email_address_header()
-    # Divide addresses based on preferred email formats
+
+    user_ids = []
     for addr in destinations:
         if mail_util.isvalid(addr):
             addrs_plain.append(addr)
+            sources[addr] = addr
         else:
             try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
+                user_ids.append(ObjectId(addr))
             except Exception:
                 log.exception('Error looking up user with ID: %r' % addr)
-                continue
-            addr = user.email_address_header()
-            if not addr and user.email_addresses:
-                addr = user.email_addresses[0]
-                log.warning(
-                    'User %s has not set primary email address, using %s',
-                    user._id, addr)
-            if not addr:
-                log.error(
-                    "User %s (%s) has not set any email address, can't deliver",
-                    user._id, user.username)
-                continue
-            if user.get_pref('email_format') == 'plain':
-                addrs_plain.append(addr)
-            else:
-                addrs_multi.append(addr)
+    users = {}
+    if user_ids:
+        users = {u._id: u for u in M.User.query.find({
+            '_id': {'$in': user_ids},
+            'disabled': False,
+            'pending': False,
+        })}
 
+    # Divide addresses based on preferred email formats
+    for user_id in user_ids:
+        user = users.get(user_id)
+        if not user:
+            log.warning('Cannot find user with ID: %s', user_id)
+            continue
+        addr = user.email_address_header()
+        if not addr and user.email_addresses:
+            addr = user.email_addresses[0]
+            log.warning(
+                'User %s has not set primary email address, using %s',
+                user._id, addr)
+        if not addr:
+            log.error(
+                "User %s (%s) has not set any email address, can't deliver",
+                user._id, user.username)
+            continue
+        if user.get_pref('email_format') == 'plain':
+            addrs_plain.append(addr)
+        else:
+            addrs_multi.append(addr)
+        sources[str(addr)] = str(user_id)
+
+    max_recipients = asint(config.get('forgemail.max_envelope_recipients', 100))
     multi_msg, plain_msg = create_multipart_msg(text, metalink)
-    smtp_client.sendmail(
-        addrs_multi, fromaddr, reply_to, subject, message_id,
-        in_reply_to, multi_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_plain, fromaddr, reply_to, subject, message_id,
-        in_reply_to, plain_msg, sender=sender, references=references)
+    undelivered = []
+    for addrs, msg in [(addrs_multi, multi_msg), (addrs_plain, plain_msg)]:
+        try:
+            smtp_client.sendmail(
+                addrs, fromaddr, reply_to, subject, message_id,
+                in_reply_to, msg, sender=sender, references=references,
+                max_recipients=max_recipients)
+        except exc.SMTPTransientError as e:
+            log.info('Transient error sending mail to %s recipients: %s', len(e.undelivered), e)
+            undelivered.extend(sources.get(str(a), str(a)) for a in e.undelivered)
+    if undelivered:
+        delay = _retry_delay(attempt)
+        if delay is None:
+            raise exc.MailError(f'Giving up delivery to {len(undelivered)} recipients after {attempt + 1} attempts')
+        sendmail.post(
+            fromaddr=orig_fromaddr, destinations=undelivered, text=text, reply_to=reply_to, subject=subject,
+            message_id=message_id, in_reply_to=in_reply_to, sender=sender, references=references,
+            metalink=metalink, attempt=attempt + 1, delay=delay)
 
 
 @task
@@ -210,16 +254,20 @@ def sendsimplemail(
         in_reply_to=None,
         sender=None,
         references=None,
-        cc=None):
+        cc=None,
+        attempt=0):
     '''
     Send a single mail to the specified address.
     It is best for single user notifications.
 
     :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
     :param toaddr: ObjectId or str(ObjectId) of user, or email address str
+    :param attempt: number of previous delivery attempts, used for retries
 
     '''
     from allura import model as M
+    # the user ids or addresses given, as they are replaced by Headers which can't be saved in a retry
+    orig_fromaddr, orig_toaddr = fromaddr, toaddr
     if fromaddr is None:
         fromaddr = g.noreply
     elif not isinstance(fromaddr, str) or '@' not in fromaddr:
@@ -241,9 +289,19 @@ def sendsimplemail(
             toaddr = user.email_address_header()
 
     multi_msg, plain_msg = create_multipart_msg(text)
-    smtp_client.sendmail(
-        [toaddr], fromaddr, reply_to, subject, message_id,
-        in_reply_to, multi_msg, sender=sender, references=references, cc=cc, to=toaddr)
+    try:
+        smtp_client.sendmail(
+            [toaddr], fromaddr, reply_to, subject, message_id,
+            in_reply_to, multi_msg, sender=sender, references=references, cc=cc, to=toaddr)
+    except exc.SMTPTransientError as e:
+        delay = _retry_delay(attempt)
+        if delay is None:
+            raise
+        log.info('Transient error sending mail to %s, retrying in %ss: %s', toaddr, delay, e)
+        sendsimplemail.post(
+            fromaddr=orig_fromaddr, toaddr=orig_toaddr, text=text, reply_to=reply_to, subject=subject,
+            message_id=message_id, in_reply_to=in_reply_to, sender=sender, references=references,
+            cc=cc, attempt=attempt + 1, delay=delay)
 
 
 def send_system_mail_to_user(user_or_emailaddr, subject, text):
@@ -149,6 +149,8 @@ def tarball(revision, path):
                     'Could not create snapshot for repository: %s:%s revision %s path %s' %
                     (c.project.shortname, c.app.config.options.mount_point, revision, path), exc_info=True)
                 raise
+            finally:
+                repo.prune_tarballs()
     else:
         log.warning(
             'Skipped creation of snapshot: %s:%s because revision is not specified' %
@@ -1076,7 +1076,7 @@ def test_selected_one_tool(self, export_tasks):
         r = self.app.post('/admin/export', {'tools': 'wiki'})
         assert 'ok' in self.webflash(r)
         export_tasks.bulk_export.post.assert_called_once_with(
-            ['wiki'], 'test.zip', send_email=True, with_attachments=False)
+            ['wiki'], 'test.zip', send_email=True, with_attachments=False, incremental=False)
 
     @mock.patch('allura.ext.admin.admin_main.export_tasks')
     @mock.patch.dict(tg.config, {'bulk_export_filename': '{project}.zip'})
@@ -1084,7 +1084,7 @@ def test_selected_multiple_tools(self, export_tasks):
         r = self.app.post('/admin/export', {'tools': ['wiki', 'wiki2']})
         assert 'ok' in self.webflash(r)
         export_tasks.bulk_export.post.assert_called_once_with(
-            ['wiki', 'wiki2'], 'test.zip', send_email=True, with_attachments=False)
+            ['wiki', 'wiki2'], 'test.zip', send_email=True, with_attachments=False, incremental=False)
 
     @mock.patch('allura.model.session.project_doc_session')
     def test_export_in_progress(self, session):
@@ -1136,7 +1136,7 @@ def test_export_status(self, MonQTask):
 
         MonQTask.query.get.return_value = 'something'
         r = self.api_get('/rest/p/test/admin/export_status')
-        assert r.json == {'status': 'busy'}
+        assert r.json == {'status': 'busy', 'progress': {}}
 
     @mock.patch('allura.model.project.MonQTask')
     @mock.patch('allura.ext.admin.admin_main.AdminApp.exportable_tools_for')
@@ -1190,7 +1190,21 @@ def test_export_ok(self, bulk_export, exportable_tools, MonQTask):
             'status': 'in progress',
         }
         bulk_export.post.assert_called_once_with(
-            ['tickets', 'discussion'], 'test.zip', send_email=False, with_attachments=False)
+            ['tickets', 'discussion'], 'test.zip', send_email=False, with_attachments=False, incremental=False)
+
+    @mock.patch('allura.model.project.MonQTask')
+    @mock.patch('allura.ext.admin.admin_main.AdminApp.exportable_tools_for')
+    @mock.patch('allura.ext.admin.admin_main.export_tasks.bulk_export')
+    @mock.patch.dict(tg.config, {'bulk_export_filename': '{project}.zip'})
+    def test_export_incremental(self, bulk_export, exportable_tools, MonQTask):
+        MonQTask.query.get.return_value = None
+        exportable_tools.return_value = [
+            mock.Mock(options=mock.Mock(mount_point='tickets')),
+        ]
+        self.api_post('/rest/p/test/admin/export',
+                      tools='tickets', incremental='true', status=200)
+        bulk_export.post.assert_called_once_with(
+            ['tickets'], 'test.zip', send_email=False, with_attachments=False, incremental=True)
 
 
 class TestRestInstallTool(TestRestApiBase):
@@ -397,6 +397,23 @@ def test_post_notify(self):
             else:
                 assert False, 'send_simple must not be called'
 
+    def test_post_meta_many(self):
+        from forgewiki.model import Page
+        pages = [Page.upsert(title='Page %s' % n) for n in range(3)]
+        pages[0].discussion_thread.post('Comment')
+        ThreadLocalODMSession.flush_all()
+        posts = M.Thread.post_meta_many((page, 'Changed %s' % page.title) for page in pages)
+        assert not list(session(M.Post).uow.new)
+        ThreadLocalODMSession.flush_all()
+        for page, post in zip(pages, posts):
+            thread = M.Thread.query.get(ref_id=page.index_id())
+            assert post.thread_id == thread._id
+            assert M.Post.query.get(_id=post._id).text == 'Changed %s' % page.title
+            assert post.is_meta and post.status == 'ok'
+            assert post.version == 1
+            assert abs(thread.last_post_date - post.mod_date) < timedelta(seconds=1)
+        assert [M.Thread.query.get(ref_id=p.index_id()).num_replies for p in pages] == [2, 1, 1]
+
     @patch('allura.model.discuss.c.project.users_with_role')
     def test_is_spam_for_admin(self, users):
         users.return_value = [c.user, ]
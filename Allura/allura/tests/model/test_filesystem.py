@@ -16,16 +16,19 @@
 #       under the License.
 
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 from io import BytesIO
 
 import ming
-from tg import tmpl_context as c
+from tg import tmpl_context as c, config
 from ming.odm import session, Mapper
 from mock import patch
-from webob import Request, Response
+from webob import Request, Response, exc
 
 from allura import model as M
+from allura.lib import helpers as h
 from alluratest.controller import setup_unit_test
 
 
@@ -151,6 +154,81 @@ def test_serve_embed_false(self):
             assert response.content_type == f.content_type
             assert response.headers['Content-Disposition'] == 'attachment;filename="te%20s%E0%AD%AE1.txt"'
 
+    def test_serve_range(self):
+        f = File.from_data('test.txt', b'0123456789')
+        self.session.flush()
+        request = Request.blank('/', headers={'Range': 'bytes=2-4'})
+        with patch('allura.lib.utils.tg.request', request), \
+                patch('allura.lib.utils.tg.response', Response()) as response, \
+                patch('allura.lib.utils.etag_cache'):
+            response_body = b''.join(f.serve())
+            assert response_body == b'234'
+            assert response.status_int == 206
+            assert response.headers['Content-Range'] == 'bytes 2-4/10'
+            assert response.content_length == 3
+
+        request = Request.blank('/', headers={'Range': 'bytes=0-1,-2'})
+        with patch('allura.lib.utils.tg.request', request), \
+                patch('allura.lib.utils.tg.response', Response()) as response, \
+                patch('allura.lib.utils.etag_cache'):
+            response_body = b''.join(f.serve())
+            assert response.status_int == 206
+            assert response.content_type == 'multipart/byteranges'
+            assert b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n' in response_body
+            assert b'Content-Range: bytes 8-9/10\r\n\r\n89\r\n' in response_body
+            assert response.content_length == len(response_body)
+
+        request = Request.blank('/', headers={'Range': 'bytes=20-'})
+        with patch('allura.lib.utils.tg.request', request), \
+                patch('allura.lib.utils.tg.response', Response()) as response, \
+                patch('allura.lib.utils.etag_cache'):
+            assert list(f.serve()) == []
+            assert response.status_int == 416
+            assert response.headers['Content-Range'] == 'bytes */10'
+
+    def test_serve_not_modified(self):
+        f = File.from_data('test.txt', b'test1')
+        self.session.flush()
+        request = Request.blank('/')
+        request.if_modified_since = f._id.generation_time
+        with patch('allura.lib.utils.tg.request', request), \
+                patch('allura.lib.utils.tg.response', Response()), \
+                patch('allura.lib.utils.etag_cache'), \
+                patch.object(File, 'rfile') as rfile:
+            with self.assertRaises(exc.HTTPNotModified):
+                f.serve()
+            assert not rfile.called
+
+    def test_serve_offload(self):
+        f = File.from_data('test.txt', b'test1')
+        self.session.flush()
+        offload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, offload_dir)
+        with h.push_config(config, **{'files.offload_header': 'X-Accel-Redirect',
+                                      'files.offload_dir': offload_dir}), \
+                patch('allura.lib.utils.tg.request', Request.blank('/')), \
+                patch('allura.lib.utils.tg.response', Response()) as response, \
+                patch('allura.lib.utils.etag_cache'):
+            assert list(f.serve()) == []
+            name = str(f.file_id)
+            assert response.headers['X-Accel-Redirect'] == f'/_files/{name[-2:]}/{name}'
+            assert response.content_type == f.content_type
+            with open(os.path.join(offload_dir, name[-2:], name), 'rb') as fp:
+                assert fp.read() == b'test1'
+            f.delete()
+            assert not os.path.exists(os.path.join(offload_dir, name[-2:], name))
+
+    def test_serve_offload_without_dir(self):
+        f = File.from_data('test.txt', b'test1')
+        self.session.flush()
+        with h.push_config(config, **{'files.offload_header': 'X-Accel-Redirect',
+                                      'files.offload_dir': None}), \
+                patch('allura.lib.utils.tg.request', Request.blank('/')), \
+                patch('allura.lib.utils.tg.response', Response()) as response, \
+                patch('allura.lib.utils.etag_cache'):
+            assert b''.join(f.serve()) == b'test1'
+            assert 'X-Accel-Redirect' not in response.headers
+
     def test_image(self):
         path = os.path.join(
             os.path.dirname(__file__), '..', 'data', 'user.png')
@@ -15,9 +15,20 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import mock
+import pytest
+from bson import ObjectId
+from ming.odm import ThreadLocalODMSession
+from tg import config, app_globals as g
+
 from allura import model as M
+from allura.lib import helpers as h
+from allura.model.timeline import (
+    get_activity_objects, perm_check, TimelineCache, TransientActor, get_permitted_timeline,
+    encode_cursor, decode_cursor)
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test, setup_global_objects
+from forgewiki import model as WM
 
 
 class TestActivityObject_Functional:
@@ -37,4 +48,88 @@ def test_has_activity_access_app_config(self):
         app_config = wiki_app.config
 
         assert (bool(app_config.has_activity_access('read', user=M.User.anonymous(), activity=None)) is
-                     True)
\ No newline at end of file
+                     True)
+    @td.with_wiki
+    def test_perm_check_batched(self):
+        h.set_context('test', 'wiki', neighborhood='Projects')
+        pages = [WM.Page(title='Page%d' % i) for i in range(3)]
+        ThreadLocalODMSession.flush_all()
+        activities = [mock.Mock(obj=mock.Mock(activity_extras={'allura_id': pg.allura_id}))
+                      for pg in pages]
+        activities.append(mock.Mock(obj=mock.Mock(activity_extras={'allura_id': 'Page:%s' % ObjectId()})))
+        activities.append(mock.Mock(obj=mock.Mock(activity_extras={})))
+
+        objects = get_activity_objects([a.obj for a in activities])
+        assert objects == {pg.allura_id: pg for pg in pages}
+
+        # pages without ACLs of their own share the wiki's access
+        assert len({pg.activity_access_key(None) for pg in pages}) == 1
+        check = perm_check(M.User.anonymous(), objects)
+        with mock.patch.object(WM.Page, 'has_activity_access', autospec=True,
+                               return_value=True) as has_activity_access:
+            assert [check(a) for a in activities] == [True, True, True, False, True]
+        assert has_activity_access.call_count == 1
+
+        pages[0].acl = [M.ACE.deny(M.ProjectRole.anonymous()._id, 'read')]
+        assert pages[0].activity_access_key(None) is None
+        check = perm_check(M.User.anonymous(), objects)
+        assert [check(a) for a in activities] == [False, True, True, False, True]
+
+    def test_timeline_cache(self):
+        user = M.User.by_username('test-admin')
+        follower = M.User.by_username('test-user')
+        with h.push_config(config, **{'activitystream.timeline_cache_size': '10'}):
+            g.director.connect(follower, user)
+            assert TimelineCache.query.get(node_id=follower.node_id) is None
+            # the cache is started on first read
+            assert g.director.get_timeline(follower, limit=10) == []
+            assert TimelineCache.query.get(node_id=follower.node_id).activities == []
+
+            for verb in ('created', 'modified'):
+                g.director.create_activity(user, verb, TransientActor('thing'))
+            cache = TimelineCache.query.find({'node_id': follower.node_id}, refresh=True).first()
+            assert len(cache.activities) == 2
+            # only started caches are added to
+            assert TimelineCache.query.get(node_id=user.node_id) is None
+
+            with mock.patch.object(g.director, 'create_timeline') as create_timeline:
+                timeline = g.director.get_timeline(follower, limit=10)
+                assert [a.verb for a in timeline] == ['modified', 'created']
+                timeline = g.director.get_timeline(follower, page=1, limit=1)
+                assert [a.verb for a in timeline] == ['created']
+                assert g.director.get_timeline(follower, limit=10, actor_only=True) == []
+                assert create_timeline.call_count == 0
+
+            TimelineCache.remove_activities([cache.activities[0].activity_id])
+            cache = TimelineCache.query.find({'node_id': follower.node_id}, refresh=True).first()
+            assert len(cache.activities) == 1
+
+    def test_timeline_cursor_same_score(self):
+        user = M.User.by_username('test-admin')
+        verbs = ['created', 'modified', 'deleted']
+        # all in the same second, so with the same score
+        with mock.patch('allura.model.timeline.time.mktime', return_value=1000.0):
+            for verb in verbs:
+                g.director.create_activity(user, verb, TransientActor('thing'))
+        ThreadLocalODMSession.flush_all()
+        for cache_size in ('0', '10'):
+            with h.push_config(config, **{'activitystream.timeline_cache_size': cache_size}):
+                seen = []
+                before = None
+                while True:
+                    timeline, before, has_more = get_permitted_timeline(
+                        user, user, 1, before=before, actor_only=True)
+                    seen += [a.verb for a in timeline]
+                    if not has_more:
+                        break
+                    before = decode_cursor(encode_cursor(before))
+                assert sorted(seen) == sorted(verbs)
+                assert len(seen) == len(verbs)
+
+    def test_decode_cursor(self):
+        _id = ObjectId()
+        assert decode_cursor(encode_cursor((1000.5, _id))) == (1000.5, _id)
+        assert decode_cursor('1000.5') == (1000.5, None)
+        for token in ('foo', '1000.5:foo'):
+            with pytest.raises(ValueError):
+                decode_cursor(token)
@@ -16,9 +16,14 @@
 #       under the License.
 
 import os
+import gzip
+import json
+from datetime import datetime
 from shutil import rmtree
 import xml.etree.ElementTree as ET
 
+import mock
+from ming.odm import ThreadLocalODMSession
 from tg import tmpl_context as c
 from testfixtures import TempDirectory
 
@@ -55,3 +60,43 @@ def test_create(self):
             urls = [loc.text for loc in xml_0.findall('ns0:url/ns0:loc', ns)]
             assert 'http://localhost/p/wiki/' not in urls  # blank wiki pages omitted from sitemap
             assert 'http://localhost/p/test/sub1/' in urls
+
+    def test_create_sharded(self):
+        with TempDirectory() as tmpdir:
+            rmtree(tmpdir.path)  # needs to be non-existent for the script
+            self.run_script(['-o', tmpdir.path, '--processes', '1', '--shard-size', '2'])
+
+            with open(os.path.join(tmpdir.path, 'sitemap-shards.json')) as f:
+                shards = json.load(f)['shards']
+            assert len(shards) > 1
+            assert shards[0]['start'] is None and shards[-1]['end'] is None
+            files = [fn for s in shards for fn in s['files']]
+            assert all(fn.endswith('.xml.gz') for fn in files)
+
+            ns = {'ns0': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
+            xml_index = ET.parse(os.path.join(tmpdir.path, 'sitemap.xml'))
+            locs = [loc.text for loc in xml_index.findall('ns0:sitemap/ns0:loc', ns)]
+            assert locs == ['http://localhost/allura_sitemap/' + fn for fn in files]
+
+            urls = []
+            for fn in files:
+                with gzip.open(os.path.join(tmpdir.path, fn)) as f:
+                    urls += [loc.text for loc in ET.parse(f).findall('ns0:url/ns0:loc', ns)]
+            assert 'http://localhost/p/wiki/' not in urls
+            assert 'http://localhost/p/test/sub1/' in urls
+
+            # nothing changed, nothing to regenerate
+            with mock.patch.object(CreateSitemapFiles, 'write_shard') as write_shard:
+                self.run_script(['-o', tmpdir.path, '--incremental'])
+            assert not write_shard.called
+
+            p = M.Project.query.get(shortname='test/sub1')
+            p.last_updated = datetime.utcnow()
+            ThreadLocalODMSession.flush_all()
+            with mock.patch.object(CreateSitemapFiles, 'write_shard',
+                                   wraps=CreateSitemapFiles.write_shard) as write_shard:
+                self.run_script(['-o', tmpdir.path, '--incremental'])
+            assert write_shard.call_count == 1
+            shard = write_shard.call_args[0][2]
+            assert shard['start'] is None or shard['start'] <= str(p._id)
+            assert shard['end'] is None or str(p._id) < shard['end']
@@ -15,9 +15,12 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from datetime import datetime, timedelta
+
 from bson import ObjectId
 
 from allura.scripts.clear_old_notifications import ClearOldNotifications
+from allura.scripts.clear_old_stats_buckets import ClearOldStatsBuckets
 from alluratest.controller import setup_basic_test
 from allura import model as M
 from ming.odm import session
@@ -42,3 +45,19 @@ def test(self):
         assert M.Notification.query.find().count() == 1
         self.run_script(['--back-days', '0'])
         assert M.Notification.query.find().count() == 0
+
+
+class TestClearOldStatsBuckets:
+
+    def setup_method(self, method):
+        setup_basic_test()
+
+    def test(self):
+        stats_id = ObjectId()
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        for day in (today, today - timedelta(40)):
+            M.stats.StatsBucket.query.update(
+                dict(stats_id=stats_id, day=day, category=None), {'$inc': {'created': 1}}, upsert=True)
+        cls = ClearOldStatsBuckets
+        cls.execute(cls.parser().parse_args([]))
+        assert [b.day for b in M.stats.StatsBucket.query.find(dict(stats_id=stats_id))] == [today]
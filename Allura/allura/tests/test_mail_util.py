@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import asyncio
 import unittest
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -25,6 +26,7 @@
 from tg import config as tg_config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
+from allura import model as M
 from allura.command.smtp_server import MailServer
 from allura.lib.utils import ConfigProxy
 from allura.app import Application
@@ -333,8 +335,49 @@ def setup_method(self, method):
     @mock.patch('allura.command.base.log', autospec=True)
     def test(self, log):
         listen_port = ('0.0.0.0', 8825)
-        mailserver = MailServer(listen_port, None)
+        mailserver = MailServer(listen_port)
         mailserver.process_message('127.0.0.1', 'foo@bar.com', ['1234@tickets.test.p.localhost'],
                                    'this is the email body with headers and everything ÎÅ¸'.encode())
+        assert len(mailserver.pending) == 1
+        tasks = mailserver.flush()
         assert [] == log.exception.call_args_list
-        assert log.info.call_args[0][0].startswith('Msg passed along as task '), log.info.call_args
+        assert log.info.call_args[0][0].endswith('msgs passed along as tasks %s'), log.info.call_args
+        assert len(tasks) == 1
+        assert tasks[0].kwargs['rcpttos'] == ['1234@tickets.test.p.localhost']
+        assert M.MonQTask.query.get(_id=tasks[0]._id)
+        assert mailserver.pending == []
+
+    @mock.patch('allura.command.base.log', autospec=True)
+    def test_batch_size(self, log):
+        mailserver = MailServer(('0.0.0.0', 8825), batch_size=2)
+        with mock.patch.object(mailserver, 'flush') as flush:
+            mailserver.process_message('127.0.0.1', 'foo@bar.com', ['a@tickets.test.p.localhost'], b'one')
+            assert flush.call_count == 0
+            mailserver.process_message('127.0.0.1', 'foo@bar.com', ['a@tickets.test.p.localhost'], b'two')
+            assert flush.call_count == 1
+
+    @mock.patch('allura.command.base.log', autospec=True)
+    def test_handle_data_acknowledges_once_posted(self, log):
+        mailserver = MailServer(('0.0.0.0', 8825))
+        envelope = mock.Mock(mail_from='foo@bar.com', rcpt_tos=['a@tickets.test.p.localhost'],
+                             original_content=b'body')
+
+        async def deliver():
+            reply = asyncio.ensure_future(mailserver.handle_DATA(None, mock.Mock(peer='127.0.0.1'), envelope))
+            await asyncio.sleep(0)
+            assert not reply.done()  # not acknowledged until the task is saved
+            mailserver.flush()
+            return await reply
+
+        assert asyncio.run(deliver()) == '250 OK'
+        assert M.MonQTask.query.find({'task_name': 'allura.tasks.mail_tasks.route_email'}).count() == 1
+
+    @mock.patch('allura.command.base.log', autospec=True)
+    def test_handle_data_failure(self, log):
+        mailserver = MailServer(('0.0.0.0', 8825), batch_size=1)
+        envelope = mock.Mock(mail_from='foo@bar.com', rcpt_tos=['a@tickets.test.p.localhost'],
+                             original_content=b'body')
+        with mock.patch('allura.tasks.mail_tasks.route_email.post', side_effect=ValueError):
+            reply = asyncio.run(mailserver.handle_DATA(None, mock.Mock(peer='127.0.0.1'), envelope))
+        assert reply.startswith('451 ')
+        assert log.exception.call_count == 1
@@ -15,8 +15,12 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import json
 import operator
+import os
 import shutil
+import smtplib
+import zipfile
 from textwrap import dedent
 import unittest
 
@@ -24,6 +28,7 @@
 from base64 import b64encode
 import logging
 import pkg_resources
+import pytest
 
 import tg
 import mock
@@ -38,6 +43,7 @@
 from allura import model as M
 from allura.command.taskd import TaskdCommand
 from allura.lib import helpers as h
+from allura.lib.exceptions import MailError
 from allura.lib.mail_util import MAX_MAIL_LINE_OCTETS
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
@@ -277,6 +283,96 @@ def test_send_email_ascii_with_user_lookup(self):
             assert (
                 '<div class="markdown_content"><p>This is a test</p></div>' in body)
 
+    @mock.patch.dict(tg.config, {'forgemail.max_envelope_recipients': '2'})
+    def test_send_email_shared_envelopes(self):
+        users = [M.User.by_username(u) for u in ('test-admin', 'test-user', 'test-user-1')]
+        for i, u in enumerate(users):
+            u.preferences['email_address'] = 'user%s@mail.com' % i
+        ThreadLocalODMSession.flush_all()
+        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+            mail_tasks.sendmail(
+                fromaddr='foo@bar.com',
+                destinations=[str(u._id) for u in users],
+                text='This is a test',
+                reply_to=g.noreply,
+                subject='Test subject',
+                message_id=h.gen_message_id())
+            assert _client.sendmail.call_count == 2
+            rcpts = [call[0][1] for call in _client.sendmail.call_args_list]
+            assert rcpts == [['user0@mail.com', 'user1@mail.com'], ['user2@mail.com']]
+            body1 = _client.sendmail.call_args_list[0][0][2]
+            body2 = _client.sendmail.call_args_list[1][0][2]
+            assert body1 == body2
+
+    def test_send_email_transient_error_reschedules(self):
+        user = M.User.by_username('test-user-1')
+        user.preferences['email_address'] = 'user1@mail.com'
+        ThreadLocalODMSession.flush_all()
+        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client, \
+                mock.patch.object(mail_tasks.smtp_client, '_connect', side_effect=OSError('refused')), \
+                mock.patch.object(mail_tasks.sendmail, 'post') as post:
+            _client.sendmail.side_effect = smtplib.SMTPServerDisconnected('gone')
+            mail_tasks.sendmail(
+                fromaddr='foo@bar.com',
+                destinations=[str(user._id), 'blah@blah.com'],
+                text='This is a test',
+                reply_to=g.noreply,
+                subject='Test subject',
+                message_id='msg-id')
+            assert _client.sendmail.call_count == 1  # no synchronous retry
+            # one reschedule, holding every undelivered recipient
+            assert post.call_count == 1
+            assert post.call_args[1]['destinations'] == [str(user._id), 'blah@blah.com']
+            assert post.call_args[1]['attempt'] == 1
+            assert post.call_args[1]['delay'] == 60
+            assert post.call_args[1]['message_id'] == 'msg-id'
+
+    def test_send_email_transient_error_gives_up(self):
+        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client, \
+                mock.patch.object(mail_tasks.sendmail, 'post') as post:
+            _client.sendmail.side_effect = smtplib.SMTPResponseException(421, 'try later')
+            with pytest.raises(MailError):
+                mail_tasks.sendmail(
+                    fromaddr='foo@bar.com',
+                    destinations=['blah@blah.com'],
+                    text='This is a test',
+                    reply_to=g.noreply,
+                    subject='Test subject',
+                    message_id=h.gen_message_id(),
+                    attempt=3)
+            assert post.call_count == 0
+
+    def test_send_email_transient_error_saves_retry(self):
+        user = M.User.by_username('test-user-1')
+        user.preferences['email_address'] = 'user1@mail.com'
+        ThreadLocalODMSession.flush_all()
+        M.MonQTask.query.remove()
+        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client, \
+                mock.patch.object(mail_tasks.smtp_client, '_connect', side_effect=OSError('refused')):
+            _client.sendmail.side_effect = smtplib.SMTPServerDisconnected('gone')
+            mail_tasks.sendmail(
+                fromaddr=str(user._id),
+                destinations=[str(user._id)],
+                text='This is a test',
+                reply_to=g.noreply,
+                subject='Test subject',
+                message_id='msg-id')
+            mail_tasks.sendsimplemail(
+                fromaddr=str(user._id),
+                toaddr=str(user._id),
+                text='This is a test',
+                reply_to=g.noreply,
+                subject='Test subject',
+                message_id='msg-id')
+        ThreadLocalODMSession.flush_all()
+        task = M.MonQTask.query.get(task_name='allura.tasks.mail_tasks.sendmail')
+        assert task.kwargs['fromaddr'] == str(user._id)
+        assert task.kwargs['destinations'] == [str(user._id)]
+        task = M.MonQTask.query.get(task_name='allura.tasks.mail_tasks.sendsimplemail')
+        assert task.kwargs['fromaddr'] == str(user._id)
+        assert task.kwargs['toaddr'] == str(user._id)
+        assert task.kwargs['attempt'] == 1
+
     def test_send_email_nonascii(self):
         with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
             mail_tasks.sendmail(
@@ -629,17 +725,17 @@ def test_bulk_export_filter_successful(self):
         self.assertEqual(
             BE.filter_successful(['foo', None, '0']), ['foo', '0'])
 
-    @mock.patch('allura.tasks.export_tasks.shutil')
-    @mock.patch('allura.tasks.export_tasks.zipdir')
     @mock.patch.dict(tg.config, {'bulk_export_filename': '{project}.zip'})
     @td.with_wiki
-    def test_bulk_export(self, zipdir, shutil):
+    def test_bulk_export(self):
         M.MonQTask.query.remove()
         export_tasks.bulk_export(['wiki'])
         temp = '/tmp/bulk_export/p/test/test'
         zipfn = '/tmp/bulk_export/p/test/test.zip'
-        zipdir.assert_called_with(temp, zipfn)
-        shutil.rmtree.assert_called_once_with(six.ensure_binary(temp))
+        with zipfile.ZipFile(zipfn) as zf:
+            assert zf.namelist() == ['test/wiki.json']
+            assert json.loads(zf.read('test/wiki.json'))['pages']
+        assert not os.path.exists(temp)
         # check notification
         tasks = M.MonQTask.query.find(
             dict(task_name='allura.tasks.mail_tasks.sendsimplemail')).all()
@@ -658,6 +754,67 @@ def test_bulk_export_status(self):
         export_tasks.bulk_export.post(['wiki'])
         assert c.project.bulk_export_status() == 'busy'
 
+    @td.with_wiki
+    def test_bulk_export_incremental(self):
+        app = c.project.app_instance('wiki')
+        export_path = '/tmp/bulk_export/p/test/test'
+        os.makedirs(export_path, exist_ok=True)
+        BE = export_tasks.BulkExport()
+        with mock.patch.object(app, 'bulk_export') as bulk_export:
+            BE.export(export_path, app, incremental=True)
+            bulk_export.assert_called_once_with(mock.ANY, export_path, False, since=None)
+            mark = app.config.bulk_export_mark
+            assert mark
+
+            bulk_export.reset_mock()
+            BE.export(export_path, app, incremental=True)
+            bulk_export.assert_called_once_with(mock.ANY, export_path, False, since=mark)
+            assert app.config.bulk_export_mark >= mark
+
+            # a full export doesn't move the mark
+            mark = app.config.bulk_export_mark
+            bulk_export.reset_mock()
+            BE.export(export_path, app)
+            bulk_export.assert_called_once_with(mock.ANY, export_path, False)
+            assert app.config.bulk_export_mark == mark
+
+    @mock.patch.dict(tg.config, {'bulk_export_filename': '{project}.zip', 'bulk_export_concurrency': '2'})
+    @td.with_wiki
+    @td.with_tool('test', 'Wiki', 'wiki2', 'Wiki2')
+    def test_bulk_export_parallel(self):
+        M.MonQTask.query.remove()
+        export_tasks.bulk_export(['wiki', 'wiki2', 'admin', 'nonexistent'])
+        project = M.Project.query.get(shortname='test')
+        assert project.bulk_export_progress == {
+            'wiki': 'busy', 'wiki2': 'busy', 'admin': 'queued', 'nonexistent': 'skipped'}
+        tool_tasks = M.MonQTask.query.find(
+            dict(task_name='allura.tasks.export_tasks.bulk_export_tool')).all()
+        assert [t.args[0] for t in tool_tasks] == ['wiki', 'wiki2']
+        assert project.bulk_export_status() == 'busy'
+
+        # a finished task starts the next queued tool
+        tool_tasks[0]()
+        assert project.bulk_export_progress == {
+            'wiki': 'done', 'wiki2': 'busy', 'admin': 'busy', 'nonexistent': 'skipped'}
+        tool_tasks = M.MonQTask.query.find(
+            dict(task_name='allura.tasks.export_tasks.bulk_export_tool')).sort('_id').all()
+        assert [t.args[0] for t in tool_tasks] == ['wiki', 'wiki2', 'admin']
+        tool_tasks[2]()
+        assert project.bulk_export_progress == {
+            'wiki': 'done', 'wiki2': 'busy', 'admin': 'done', 'nonexistent': 'skipped'}
+        assert not os.path.exists('/tmp/bulk_export/p/test/test.zip')
+
+        # the last one builds the zip
+        tool_tasks[1]()
+        assert not project.bulk_export_progress
+        with zipfile.ZipFile('/tmp/bulk_export/p/test/test.zip') as zf:
+            assert sorted(zf.namelist()) == ['test/admin.json', 'test/wiki.json', 'test/wiki2.json']
+        assert not os.path.exists('/tmp/bulk_export/p/test/test')
+        tasks = M.MonQTask.query.find(
+            dict(task_name='allura.tasks.mail_tasks.sendsimplemail')).all()
+        assert len(tasks) == 1
+        assert 'The following tools were exported:\n- wiki\n- wiki2\n- admin' in tasks[0].kwargs['text']
+
 
 class TestAdminTasks(unittest.TestCase):
 
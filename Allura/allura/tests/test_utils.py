@@ -19,6 +19,7 @@
 import time
 import unittest
 import datetime as dt
+from io import BytesIO
 from os import path
 
 import six
@@ -103,6 +104,43 @@ def test_chunked_list(self):
         self.assertEqual([el for sublist in chunks for el in sublist], l)
 
 
+class TestKeyset(unittest.TestCase):
+
+    def test_keyset_query(self):
+        sort = utils.keyset_sort([('num', -1), ('name', 1)])
+        items = [Mock(_id=1, num=3, spec=['_id', 'num', 'name']),
+                 Mock(_id=2, num=2, spec=['_id', 'num', 'name']),
+                 Mock(_id=3, num=2, spec=['_id', 'num', 'name'])]
+        items[0].name = 'c'
+        items[1].name = items[2].name = 'b'
+        token = utils.keyset_token(items, sort)
+        # ties are broken by _id
+        self.assertEqual(utils.keyset_query({'app': 'x'}, sort, token), {
+            'app': 'x',
+            '$or': [
+                {'num': {'$lt': 2}},
+                {'num': None},
+                {'num': 2, 'name': {'$gt': 'b'}},
+                {'num': 2, 'name': 'b', '_id': {'$gt': 3}},
+            ]})
+        self.assertIsNone(utils.keyset_token([], sort))
+
+    def test_keyset_sort(self):
+        # in the last key's direction, so one index can serve the whole sort
+        self.assertEqual(utils.keyset_sort([('num', -1)]), [('num', -1), ('_id', -1)])
+        self.assertEqual(utils.keyset_sort([('num', 1), ('name', -1)]), [('num', 1), ('name', -1), ('_id', -1)])
+        self.assertEqual(utils.keyset_sort([('_id', -1)]), [('_id', -1)])
+        self.assertEqual(utils.keyset_sort([('ticket_num', -1)], unique='ticket_num'), [('ticket_num', -1)])
+        self.assertEqual(utils.keyset_sort([('status', 1)], unique='ticket_num'), [('status', 1), ('ticket_num', 1)])
+
+    def test_keyset_query_invalid(self):
+        with pytest.raises(ValueError):
+            utils.keyset_query({}, [('num', 1)], 'bogus')
+        token = utils.keyset_token([Mock(_id=1, num=1)], [('num', 1)])
+        with pytest.raises(ValueError):
+            utils.keyset_query({}, [('num', 1), ('name', 1)], token)
+
+
 class TestAntispam(unittest.TestCase):
 
     def setup_method(self, method):
@@ -433,3 +471,32 @@ def test_urlencode():
     # list of pairs - including unicode and bytes
     assert (utils.urlencode([('a', 1), ('b', 'ƒ'), ('c', 'ƒ'.encode())]) ==
             'a=1&b=%C6%92&c=%C6%92')
+
+
+def test_http_ranges():
+    assert utils.http_ranges('bytes=2-4', 10) == [(2, 5)]
+    assert utils.http_ranges('bytes=0-1,-2', 10) == [(0, 2), (8, 10)]
+    assert utils.http_ranges('bytes=20-', 10) == []
+    assert utils.http_ranges('items=0-1', 10) is None
+    # overlapping, adjacent and repeated ranges are merged, in order
+    assert utils.http_ranges('bytes=6-8,0-1,0-1,2-3,7-', 10) == [(0, 4), (6, 10)]
+    # ranges covering the whole file are not worth a 206
+    assert utils.http_ranges('bytes=0-4,3-', 10) is None
+    assert utils.http_ranges('bytes=' + ','.join(['0-0'] * 50), 10) is None
+
+
+def test_iter_growing_file():
+    fp = BytesIO(b'0123456789')
+    assert b''.join(utils.iter_growing_file(fp, lambda: False, block_size=4)) == b'0123456789'
+
+    fp = BytesIO(b'0123')
+    chunks = utils.iter_growing_file(fp, lambda: False, lambda: True, block_size=4)
+    assert next(chunks) == b'0123'
+    with pytest.raises(OSError):
+        next(chunks)
+
+    fp = BytesIO(b'0123')
+    chunks = utils.iter_growing_file(fp, lambda: True, block_size=4, poll_secs=0, timeout=0)
+    assert next(chunks) == b'0123'
+    with pytest.raises(OSError):
+        next(chunks)
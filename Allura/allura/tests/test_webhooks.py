@@ -33,8 +33,10 @@
     WebhookValidator,
     WebhookController,
     send_webhook,
+    send_webhooks,
     RepoPushWebhookSender,
     SendWebhookHelper,
+    circuit_breaker,
 )
 from allura.tests import decorators as td
 from alluratest.controller import (
@@ -418,6 +420,8 @@ def setup_method(self, method):
         super().setup_method(method)
         self.payload = {'some': ['data', 23]}
         self.h = SendWebhookHelper(self.wh, self.payload)
+        circuit_breaker.failures.clear()
+        circuit_breaker.opened.clear()
 
     def test_timeout(self):
         assert self.h.timeout == 30
@@ -454,18 +458,20 @@ def test_log_msg(self):
     @patch('allura.webhooks.SendWebhookHelper', autospec=True)
     def test_send_webhook_task(self, swh):
         send_webhook(self.wh._id, self.payload)
-        swh.assert_called_once_with(self.wh, self.payload)
+        swh.assert_called_once_with(self.wh, self.payload, attempt=0)
+        send_webhook(self.wh._id, self.payload, attempt=2)
+        swh.assert_called_with(self.wh, self.payload, attempt=2)
 
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send(self, log, requests):
-        requests.post.return_value = Mock(status_code=200)
+    def test_send(self, log, http_session):
+        http_session.post.return_value = Mock(status_code=200)
         self.h.sign = Mock(return_value='sha1=abc')
         self.h.send()
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': 'sha1=abc'}
-        requests.post.assert_called_once_with(
+        http_session.post.assert_called_once_with(
             self.wh.hook_url,
             data=json.dumps(self.payload),
             headers=headers,
@@ -474,92 +480,159 @@ def test_send(self, log, requests):
             'Webhook successfully sent: {} {} {}'.format(
                 self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_response_status(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_response_status(self, log, http_session, send_webhook):
+        http_session.post.return_value = Mock(status_code=500)
         self.h.send()
-        assert requests.post.call_count == 4  # initial call + 3 retries
-        assert (time.sleep.call_args_list ==
-                     [call(60), call(120), call(240)])
-        assert log.info.call_args_list == [
-            call('Retrying webhook in: %s', [60, 120, 240]),
-            call('Retrying webhook in %s seconds', 60),
-            call('Retrying webhook in %s seconds', 120),
-            call('Retrying webhook in %s seconds', 240)]
-        assert log.error.call_count == 4
-        log.error.assert_called_with(
+        # retry is rescheduled as a new task, not waited for
+        assert http_session.post.call_count == 1
+        send_webhook.post.assert_called_once_with(self.wh._id, self.payload, attempt=1, delay=60)
+        log.info.assert_called_once_with('Retrying webhook in %s seconds (retry %s of %s)', 60, 1, 3)
+        log.error.assert_called_once_with(
             'Webhook send error: {} {} {} {} {} {}'.format(
                 self.wh.type, self.wh.hook_url,
                 self.wh.app_config.url(),
-                requests.post.return_value.status_code,
-                requests.post.return_value.text,
-                requests.post.return_value.headers))
+                http_session.post.return_value.status_code,
+                http_session.post.return_value.text,
+                http_session.post.return_value.headers))
+
+        send_webhook.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=2).send()
+        send_webhook.post.assert_called_once_with(self.wh._id, self.payload, attempt=3, delay=240)
+
+        send_webhook.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=3).send()
+        assert send_webhook.post.call_count == 0
+        log.info.assert_called_with('Giving up on webhook after %s retries', 3)
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_no_retries(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_no_retries(self, log, http_session, send_webhook):
+        http_session.post.return_value = Mock(status_code=500)
         with h.push_config(config, **{'webhook.retry': ''}):
             self.h.send()
-            assert requests.post.call_count == 1
-            assert time.call_count == 0
-            log.info.assert_called_once_with('Retrying webhook in: %s', [])
+            assert http_session.post.call_count == 1
+            assert send_webhook.post.call_count == 0
+            log.info.assert_called_once_with('Giving up on webhook after %s retries', 0)
             assert log.error.call_count == 1
-            log.error.assert_called_with(
-                'Webhook send error: {} {} {} {} {} {}'.format(
-                    self.wh.type, self.wh.hook_url,
-                    self.wh.app_config.url(),
-                    requests.post.return_value.status_code,
-                    requests.post.return_value.text,
-                    requests.post.return_value.headers))
+
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
+    def test_circuit_breaker(self, http_session, send_webhook):
+        http_session.post.return_value = Mock(status_code=500)
+        with h.push_config(config, **{'webhook.circuit_breaker.failures': '2'}):
+            self.h.send()
+            self.h.send()
+            assert http_session.post.call_count == 2
+            assert circuit_breaker.is_open('httpbin.org')
+            # host is skipped, and delivery rescheduled for when it's probed again,
+            # without using up a retry
+            self.h.send()
+            assert http_session.post.call_count == 2
+            assert send_webhook.post.call_count == 3
+            assert send_webhook.post.call_args[0] == (self.wh._id, self.payload)
+            assert send_webhook.post.call_args[1]['attempt'] == 0
+            assert 0 < send_webhook.post.call_args[1]['delay'] <= 300
+
+            # after the reset period one probe delivery is let through
+            circuit_breaker.opened['httpbin.org'] -= 301
+            http_session.post.return_value = Mock(status_code=200)
+            self.h.send()
+            assert http_session.post.call_count == 3
+            assert not circuit_breaker.is_open('httpbin.org')
+            assert 'httpbin.org' not in circuit_breaker.failures
 
 
 class TestRepoPushWebhookSender(TestWebhookBase):
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send(self, send_webhooks):
         sender = RepoPushWebhookSender()
-        sender.get_payload = Mock()
+        sender.get_payloads = Mock(return_value=[{'some': 'data'}])
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        send_webhook.post.assert_called_once_with(
-            self.wh._id,
-            sender.get_payload.return_value)
+        sender.get_payloads.assert_called_once_with([dict(arg1=1, arg2=2)])
+        send_webhooks.post.assert_called_once_with(
+            [self.wh._id],
+            [json.dumps({'some': 'data'})])
 
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_with_list(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_with_list(self, send_webhooks):
         sender = RepoPushWebhookSender()
-        sender.get_payload = Mock(side_effect=[1, 2])
+        sender.get_payloads = Mock(return_value=[1, 2])
         self.wh.enforce_limit = Mock(return_value=True)
         with h.push_config(c, app=self.git):
             sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
-        assert send_webhook.post.call_count == 2
-        assert (send_webhook.post.call_args_list ==
-                     [call(self.wh._id, 1), call(self.wh._id, 2)])
+        sender.get_payloads.assert_called_once_with([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
+        # one task for the whole push
+        send_webhooks.post.assert_called_once_with([self.wh._id], ['1', '2'])
         assert self.wh.enforce_limit.call_count == 1
 
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_task_per_webhook(self, send_webhooks):
+        wh2 = M.Webhook(
+            type='repo-push',
+            app_config_id=self.git.config._id,
+            hook_url='http://example.com/hook',
+            secret='secret')
+        session(wh2).flush(wh2)
+        sender = RepoPushWebhookSender()
+        sender.get_payloads = Mock(return_value=[1, 2])
+        with h.push_config(c, app=self.git):
+            sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
+        # a slow receiver doesn't hold up the other one
+        assert sorted(send_webhooks.post.call_args_list) == sorted([
+            call([self.wh._id], ['1', '2']),
+            call([wh2._id], ['1', '2']),
+        ])
+
     @patch('allura.webhooks.log', autospec=True)
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_limit_reached(self, send_webhook, log):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_limit_reached(self, send_webhooks, log):
         sender = RepoPushWebhookSender()
-        sender.get_payload = Mock()
+        sender.get_payloads = Mock(return_value=[])
         self.wh.enforce_limit = Mock(return_value=False)
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert send_webhook.post.call_count == 0
+        assert send_webhooks.post.call_count == 0
         log.warning.assert_called_once_with(
             'Webhook fires too often: %s. Skipping', self.wh)
 
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_no_configured_webhooks(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_no_configured_webhooks(self, send_webhooks):
         self.wh.delete()
         session(self.wh).flush(self.wh)
         sender = RepoPushWebhookSender()
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert send_webhook.post.call_count == 0
+        assert send_webhooks.post.call_count == 0
+
+    @patch('allura.webhooks.SendWebhookHelper', autospec=True)
+    def test_send_webhooks_task(self, swh):
+        send_webhooks([self.wh._id], ['{"a": 1}', '{"b": 2}'])
+        assert swh.call_args_list == [
+            call(self.wh, '{"a": 1}'),
+            call(self.wh, '{"b": 2}'),
+        ]
+
+    def test_get_payloads_shares_commits(self):
+        sender = RepoPushWebhookSender()
+        commit = MagicMock(_id='1', webhook_info={'id': '1'}, parent_ids=['0'])
+        with patch.object(M.repository.Commit, 'query') as query, \
+                patch.object(self.git.repo, 'commit') as repo_commit:
+            query.find.return_value = [commit]
+            with h.push_config(c, app=self.git):
+                result = sender.get_payloads([
+                    dict(commit_ids=['1'], ref='refs/heads/master'),
+                    dict(commit_ids=['1'], ref='refs/tags/v1'),
+                ])
+        query.find.assert_called_once_with({'_id': {'$in': ['1']}})
+        assert repo_commit.call_count == 0
+        assert [p['commits'] for p in result] == [[{'id': '1'}], [{'id': '1'}]]
+        assert [p['ref'] for p in result] == ['refs/heads/master', 'refs/tags/v1']
+        assert [p['before'] for p in result] == ['0', '0']
 
     def test_get_payload(self):
         sender = RepoPushWebhookSender()
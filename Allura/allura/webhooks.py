@@ -19,9 +19,11 @@
 import json
 import hmac
 import hashlib
+import math
 import time
 import socket
 import ssl
+from urllib.parse import urlparse
 
 import requests
 from bson import ObjectId
@@ -327,10 +329,64 @@ def _delete(self, webhook):
         return {'result': 'ok'}
 
 
+class HostCircuitBreaker:
+    """Tracks consecutive delivery failures per receiving host.
+
+    After ``webhook.circuit_breaker.failures`` consecutive failures, deliveries
+    to that host are not attempted for ``webhook.circuit_breaker.reset``
+    seconds, so a dead receiver doesn't keep taskd workers busy waiting on
+    timeouts.  State is kept per worker process.
+    """
+
+    def __init__(self):
+        self.failures = {}
+        self.opened = {}
+
+    @property
+    def max_failures(self):
+        return asint(config.get('webhook.circuit_breaker.failures', 5))
+
+    @property
+    def reset_after(self):
+        return asint(config.get('webhook.circuit_breaker.reset', 300))
+
+    def is_open(self, host):
+        opened = self.opened.get(host)
+        if opened is None:
+            return False
+        if time.time() - opened > self.reset_after:
+            # let one delivery through to probe the host again
+            del self.opened[host]
+            self.failures[host] = self.max_failures - 1
+            return False
+        return True
+
+    def retry_after(self, host):
+        """Seconds until deliveries to an open circuit's host are tried again"""
+        opened = self.opened.get(host, time.time())
+        return max(1, math.ceil(opened + self.reset_after - time.time()))
+
+    def record_success(self, host):
+        self.failures.pop(host, None)
+        self.opened.pop(host, None)
+
+    def record_failure(self, host):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.max_failures:
+            self.opened[host] = time.time()
+
+
+circuit_breaker = HostCircuitBreaker()
+
+# shared between deliveries, so connections to frequently used receivers are kept alive
+http_session = requests.Session()
+
+
 class SendWebhookHelper:
-    def __init__(self, webhook, payload):
+    def __init__(self, webhook, payload, attempt=0):
         self.webhook = webhook
         self.payload = payload
+        self.attempt = attempt
 
     @property
     def timeout(self):
@@ -341,6 +397,10 @@ def retries(self):
         t = aslist(config.get('webhook.retry', [60, 120, 240]))
         return list(map(int, t))
 
+    @property
+    def host(self):
+        return urlparse(self.webhook.hook_url).netloc
+
     def sign(self, json_payload):
         signature = hmac.new(
             self.webhook.secret.encode('utf-8'),
@@ -363,24 +423,42 @@ def log_msg(self, msg, response=None):
         return message
 
     def send(self):
-        json_payload = json.dumps(self.payload, cls=DateJSONEncoder)
+        """Deliver the payload once.  On failure, a new :func:`send_webhook`
+        task is posted with a delay from ``webhook.retry`` instead of waiting
+        in this worker.
+
+        The payload may be a dict, or a str of already serialized JSON.
+        """
+        if circuit_breaker.is_open(self.host):
+            # not an attempt, so it doesn't use up a retry
+            delay = circuit_breaker.retry_after(self.host)
+            log.warning(self.log_msg('Webhook host failing repeatedly, not sending for %s seconds' % delay))
+            send_webhook.post(self.webhook._id, self.payload, attempt=self.attempt, delay=delay)
+            return
+        if isinstance(self.payload, str):
+            json_payload = self.payload
+        else:
+            json_payload = json.dumps(self.payload, cls=DateJSONEncoder)
         signature = self.sign(json_payload)
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': signature}
         ok = self._send(self.webhook.hook_url, json_payload, headers)
-        if not ok:
-            log.info('Retrying webhook in: %s', self.retries)
-            for t in self.retries:
-                log.info('Retrying webhook in %s seconds', t)
-                time.sleep(t)
-                ok = self._send(self.webhook.hook_url, json_payload, headers)
-                if ok:
-                    return
+        if ok:
+            circuit_breaker.record_success(self.host)
+        else:
+            circuit_breaker.record_failure(self.host)
+            retries = self.retries
+            if self.attempt < len(retries):
+                delay = retries[self.attempt]
+                log.info('Retrying webhook in %s seconds (retry %s of %s)', delay, self.attempt + 1, len(retries))
+                send_webhook.post(self.webhook._id, self.payload, attempt=self.attempt + 1, delay=delay)
+            else:
+                log.info('Giving up on webhook after %s retries', len(retries))
 
     def _send(self, url, data, headers):
         try:
-            r = requests.post(
+            r = http_session.post(
                 url,
                 data=data,
                 headers=headers,
@@ -399,9 +477,25 @@ def _send(self, url, data, headers):
 
 
 @task()
-def send_webhook(webhook_id, payload):
+def send_webhook(webhook_id, payload, attempt=0):
     webhook = M.Webhook.query.get(_id=webhook_id)
-    SendWebhookHelper(webhook, payload).send()
+    if not webhook:
+        log.info('Webhook %s no longer exists, not sending', webhook_id)
+        return
+    SendWebhookHelper(webhook, payload, attempt=attempt).send()
+
+
+@task()
+def send_webhooks(webhook_ids, payloads):
+    """Deliver every payload to every webhook, in order.  Payloads are serialized
+    JSON strings, signed for each webhook as it's sent.
+
+    :class:`WebhookSender` posts one task per webhook, so a receiver timing
+    out doesn't hold up the deliveries to the others."""
+    webhooks = M.Webhook.query.find({'_id': {'$in': webhook_ids}}).all()
+    for webhook in webhooks:
+        for payload in payloads:
+            SendWebhookHelper(webhook, payload).send()
 
 
 class WebhookSender:
@@ -420,6 +514,11 @@ def get_payload(self, **kw):
         """Return a dict with webhook payload"""
         raise NotImplementedError('get_payload')
 
+    def get_payloads(self, params_list):
+        """Return a list of payloads, one for each dict of :meth:`get_payload`
+        parameters.  Subclasses can override this to share work between payloads."""
+        return [self.get_payload(**params) for params in params_list]
+
     def send(self, params_or_list):
         """Post a task that will send webhook payload
 
@@ -427,6 +526,8 @@ def send(self, params_or_list):
             :meth:`get_payload` or a list of such dicts. If it's a list for each
             element appropriate payload will be submitted, but limit will be
             enforced only once for each webhook.
+
+        All payloads for a webhook are delivered by a single task, one task per webhook.
         """
         if not isinstance(params_or_list, list):
             params_or_list = [params_or_list]
@@ -435,13 +536,12 @@ def send(self, params_or_list):
             type=self.type,
         )).all()
         if webhooks:
-            payloads = [self.get_payload(**params)
-                        for params in params_or_list]
+            payloads = [json.dumps(payload, cls=DateJSONEncoder)
+                        for payload in self.get_payloads(params_or_list)]
             for webhook in webhooks:
                 if webhook.enforce_limit():
                     webhook.update_limit()
-                    for payload in payloads:
-                        send_webhook.post(webhook._id, payload)
+                    send_webhooks.post([webhook._id], payloads)
                 else:
                     log.warning('Webhook fires too often: %s. Skipping', webhook)
 
@@ -462,10 +562,11 @@ class RepoPushWebhookSender(WebhookSender):
     type = 'repo-push'
     triggered_by = ['git', 'hg', 'svn']
 
-    def _before(self, repo, commit_ids):
+    def _before(self, repo, commit_ids, commits=None):
         if len(commit_ids) > 0:
             ci = commit_ids[-1]
-            parents = repo.commit(ci).parent_ids
+            commit = (commits or {}).get(ci) or repo.commit(ci)
+            parents = commit.parent_ids
             if len(parents) > 0:
                 # Merge commit will have multiple parents. As far as I can tell
                 # the last one will be the branch head before merge
@@ -482,16 +583,29 @@ def _convert_id(self, _id):
             _id = 'r' + _id.rsplit(':', 1)[1]
         return _id
 
-    def get_payload(self, commit_ids, **kw):
+    def get_payloads(self, params_list):
+        """Load the commits of all payloads with one query.  A commit pushed to
+        several branches/tags has its ``webhook_info`` computed only once."""
+        commit_ids = list({ci for params in params_list for ci in params['commit_ids']})
+        commits = {ci._id: ci for ci in M.repository.Commit.query.find({'_id': {'$in': commit_ids}})}
+        return [self.get_payload(commits=commits, **params) for params in params_list]
+
+    def get_payload(self, commit_ids, commits=None, **kw):
         app = kw.get('app') or c.app
-        commits = [app.repo.commit(ci).webhook_info for ci in commit_ids]
-        for ci in commits:
-            ci['id'] = self._convert_id(ci['id'])
-        before = self._before(app.repo, commit_ids)
+        commits_info = []
+        for ci in commit_ids:
+            commit = (commits or {}).get(ci)
+            if commit is None:
+                commit = app.repo.commit(ci)
+            else:
+                commit.set_context(app.repo)
+            info = commit.webhook_info
+            commits_info.append(dict(info, id=self._convert_id(info['id'])))
+        before = self._before(app.repo, commit_ids, commits)
         after = self._after(commit_ids)
         payload = {
-            'size': len(commits),
-            'commits': commits,
+            'size': len(commits_info),
+            'commits': commits_info,
             'before': before,
             'after': after,
             'repository': {
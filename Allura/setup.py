@@ -156,6 +156,7 @@
     [activitystream]
     storage = activitystream.storage.mingstorage:MingStorage
     director = allura.model.timeline:Director
+    activitymanager = allura.model.timeline:ActivityManager
     aggregator = allura.model.timeline:Aggregator
     """,
 )